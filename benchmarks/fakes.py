@@ -0,0 +1,334 @@
+# Local stand-ins for the Connect API and the Kubernetes API server, used by the benchmark harness
+# Both are seeded with a configurable number of users, groups, notebooks and GPU nodes, and keep everything in memory
+#
+#   python benchmarks/fakes.py --users 2000 --groups 50 --notebooks 200 --gpu-nodes 20
+#
+# The ports are printed as one line of JSON once both servers are listening
+
+import re
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, status, text):
+        data = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+# The Connect API
+
+class ConnectAPI:
+    def __init__(self, users, groups, latency=0.0):
+        self.latency = latency
+        self.users = dict()
+        self.groups = dict()
+        self.members = dict()
+        created = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        group_names = ["root", "root.atlas-af"] + ["root.atlas-af.group%03d" %i for i in range(groups)]
+        for name in group_names:
+            self.groups[name] = {"name": name, "display_name": name.split(".")[-1], "email": "%s@example.org" %name.split(".")[-1],
+                "phone": "555-0100", "description": "Benchmark group", "purpose": "Research", "pending": False,
+                "creation_date": created.isoformat(), "unix_id": len(self.groups) + 1000}
+            self.members[name] = dict()
+        for i in range(users):
+            username = "user%05d" %i
+            join_date = created + timedelta(days=i % 1500, hours=i % 24)
+            memberships = {"root": "active", "root.atlas-af": "admin" if i == 0 else ("pending" if i % 17 == 0 else "active")}
+            if groups:
+                memberships["root.atlas-af.group%03d" %(i % groups)] = "active"
+            self.users[username] = {"unix_name": username, "name": "User %d" %i, "email": "%s@example.org" %username,
+                "phone": "555-%04d" %(i % 10000), "institution": "Institution %d" %(i % 40),
+                "join_date": join_date.strftime("%Y-%b-%d %H:%M:%S.%f UTC"), "globus_id": str(uuid.UUID(int=i)),
+                "public_key": "", "X.509_DN": "", "unix_id": 10000 + i,
+                "group_memberships": [{"name": name, "state": state} for name, state in memberships.items()]}
+            for name, state in memberships.items():
+                self.members[name][username] = state
+
+    def route(self, method, path, query, body):
+        parts = path.strip("/").split("/")[1:]
+        if parts == ["find_user"]:
+            globus_id = query.get("globus_id", [""])[0]
+            user = next((user for user in self.users.values() if user["globus_id"] == globus_id), None)
+            return (200, {"kind": "User", "metadata": user}) if user else (404, {"kind": "Error", "message": "Not found"})
+        if parts[0] == "users" and len(parts) == 2:
+            user = self.users.get(parts[1])
+            if not user:
+                return 404, {"kind": "Error", "message": "Not found"}
+            if method == "PUT":
+                user.update({key: value for key, value in body["metadata"].items() if key in user})
+            return 200, {"kind": "User", "metadata": user}
+        if parts[0] == "groups" and len(parts) >= 2:
+            group = self.groups.get(parts[1])
+            if not group:
+                return 404, {"kind": "Error", "message": "Not found"}
+            if len(parts) == 2:
+                return 200, {"kind": "Group", "metadata": group}
+            if parts[2] == "members" and len(parts) == 3:
+                return 200, {"memberships": [{"user_name": username, "state": state} for username, state in self.members[parts[1]].items()]}
+            if parts[2] == "subgroups":
+                prefix = parts[1] + "."
+                return 200, {"groups": [group for name, group in self.groups.items() if name.startswith(prefix) and "." not in name[len(prefix):]]}
+            if parts[2] == "subgroup_requests":
+                return 200, {"groups": []}
+        return 404, {"kind": "Error", "message": "Not found"}
+
+    def handler(self):
+        api = self
+        class ConnectHandler(Handler):
+            def handle_method(self, method):
+                if api.latency:
+                    time.sleep(api.latency)
+                url = urlsplit(self.path)
+                body = self.read_json()
+                if url.path == "/v1alpha1/multiplex":
+                    results = dict()
+                    for request, options in body.items():
+                        request_url = urlsplit(request)
+                        status, result = api.route(options.get("method", "GET"), request_url.path, parse_qs(request_url.query), options.get("body"))
+                        results[request] = {"status": status, "body": json.dumps(result)}
+                    return self.send_json(200, results)
+                status, result = api.route(method, url.path, parse_qs(url.query), body)
+                self.send_json(status, result)
+        return ConnectHandler
+
+# The Kubernetes API server
+
+kinds = {"pods": "Pod", "services": "Service", "secrets": "Secret", "nodes": "Node", "ingresses": "Ingress",
+    "persistentvolumeclaims": "PersistentVolumeClaim", "events": "Event"}
+
+def parse_selector(selector):
+    terms = []
+    for term in re.split(r",(?![^(]*\))", selector or ""):
+        term = term.strip()
+        match = re.match(r"^([\w./-]+)\s+in\s+\((.*)\)$", term)
+        if match:
+            terms.append((match.group(1), "in", {value.strip() for value in match.group(2).split(",")}))
+        elif "!=" in term:
+            key, value = term.split("!=", 1)
+            terms.append((key, "!=", value))
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            terms.append((key.rstrip("="), "=", value))
+    return terms
+
+def matches(terms, values):
+    for key, op, value in terms:
+        actual = values(key)
+        if op == "in" and actual not in value or op == "=" and actual != value or op == "!=" and actual == value:
+            return False
+    return True
+
+def field(obj, path):
+    for key in path.split("."):
+        obj = obj.get(key) if isinstance(obj, dict) else None
+    return obj
+
+class KubernetesAPI:
+    def __init__(self, namespace, users, notebooks, user_notebooks, gpu_nodes, latency=0.0):
+        self.namespace = namespace
+        self.latency = latency
+        self.objects = dict()
+        self.events = []
+        self.version = 0
+        self.condition = threading.Condition()
+        self.gpu_nodes = []
+        for i in range(gpu_nodes):
+            memory = (40536, 81920, 24576)[i % 3]
+            product = {40536: "NVIDIA-A100-SXM4-40GB", 81920: "NVIDIA-A100-SXM4-80GB", 24576: "NVIDIA-A10"}[memory]
+            name = "gpu-node-%03d" %i
+            self.gpu_nodes.append((name, memory))
+            self.store("nodes", None, {"metadata": {"name": name, "labels": {"gpu": "true", "nvidia.com/gpu.product": product,
+                "nvidia.com/gpu.memory": str(memory), "nvidia.com/gpu.count": "8"}}, "status": {}})
+        for i in range(notebooks):
+            owner = "user00000" if i < user_notebooks else "user%05d" %(1 + i % max(users - 1, 1))
+            notebook_id = "%s-notebook-%d" %(owner, i)
+            gpus = 1 if gpu_nodes and i % 4 == 0 else 0
+            self.create_notebook(notebook_id, owner, gpus)
+
+    def create_notebook(self, notebook_id, owner, gpus):
+        labels = {"k8s-app": "jupyterlab", "notebook-id": notebook_id, "notebook-name": notebook_id, "owner": owner, "time2delete": "ttl-72"}
+        resources = {"requests": {"cpu": "2", "memory": "8Gi", "nvidia.com/gpu": str(gpus)}, "limits": {"cpu": "4", "memory": "16Gi", "nvidia.com/gpu": str(gpus)}}
+        self.store("pods", self.namespace, {"metadata": {"name": notebook_id, "namespace": self.namespace, "labels": labels},
+            "spec": {"containers": [{"name": notebook_id, "image": "hub.opensciencegrid.org/usatlas/ml-platform:latest", "resources": resources}]}})
+        self.store("services", self.namespace, {"metadata": {"name": notebook_id, "namespace": self.namespace}, "spec": {}})
+        self.store("ingresses", self.namespace, {"metadata": {"name": notebook_id, "namespace": self.namespace},
+            "spec": {"rules": [{"host": "%s.af.example.org" %notebook_id}]}})
+        self.store("secrets", self.namespace, {"metadata": {"name": notebook_id, "namespace": self.namespace, "labels": {"k8s-app": "jupyterlab"}},
+            "data": {"token": "dG9rZW4="}})
+
+    # Fills in what the API server would, and schedules pods onto a node right away
+    def store(self, resource, namespace, obj):
+        with self.condition:
+            metadata = obj.setdefault("metadata", {})
+            if (resource, namespace, metadata["name"]) in self.objects:
+                return 409, {"kind": "Status", "status": "Failure", "reason": "AlreadyExists", "code": 409}
+            self.version += 1
+            metadata.update(uid=str(uuid.uuid4()), resourceVersion=str(self.version), creationTimestamp=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+            obj.update(apiVersion=obj.get("apiVersion", "v1"), kind=kinds[resource])
+            if resource == "pods":
+                self.schedule(obj)
+            self.objects[(resource, namespace, metadata["name"])] = obj
+            self.publish("ADDED", resource, namespace, obj)
+            return 201, obj
+
+    def schedule(self, pod):
+        requests = pod["spec"]["containers"][0].get("resources", {}).get("requests", {})
+        gpus = int(requests.get("nvidia.com/gpu", 0))
+        memory = (pod["spec"].get("nodeSelector") or {}).get("nvidia.com/gpu.memory")
+        nodes = [name for name, node_memory in self.gpu_nodes if memory is None or str(node_memory) == str(memory)]
+        pod["spec"]["nodeName"] = nodes[self.version % len(nodes)] if gpus and nodes else "cpu-node-%03d" %(self.version % 10)
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        pod["status"] = {"phase": "Running", "conditions": [{"type": condition, "status": "True", "lastTransitionTime": now}
+            for condition in ("PodScheduled", "Initialized", "ContainersReady", "Ready")]}
+
+    def delete(self, resource, namespace, name):
+        with self.condition:
+            obj = self.objects.pop((resource, namespace, name), None)
+            if not obj:
+                return 404, {"kind": "Status", "status": "Failure", "reason": "NotFound", "code": 404}
+            self.version += 1
+            obj["metadata"]["resourceVersion"] = str(self.version)
+            self.publish("DELETED", resource, namespace, obj)
+            return 200, {"kind": "Status", "status": "Success", "code": 200}
+
+    def publish(self, event_type, resource, namespace, obj):
+        self.events.append((self.version, event_type, resource, namespace, json.dumps(obj)))
+        self.condition.notify_all()
+
+    def select(self, resource, namespace, query):
+        labels = parse_selector(query.get("labelSelector", [""])[0])
+        fields = parse_selector(query.get("fieldSelector", [""])[0])
+        def selected(obj_namespace, obj):
+            return (namespace is None or obj_namespace == namespace) \
+                and matches(labels, lambda key : (obj["metadata"].get("labels") or {}).get(key)) \
+                and matches(fields, lambda key : field(obj, key))
+        return selected
+
+    def list(self, resource, namespace, query):
+        selected = self.select(resource, namespace, query)
+        with self.condition:
+            items = [obj for (obj_resource, obj_namespace, _), obj in self.objects.items() if obj_resource == resource and selected(obj_namespace, obj)]
+            return {"apiVersion": "v1", "kind": kinds[resource] + "List", "metadata": {"resourceVersion": str(self.version)}, "items": items}
+
+    def watch(self, handler, resource, namespace, query):
+        selected = self.select(resource, namespace, query)
+        version = int(query.get("resourceVersion", ["0"])[0] or 0)
+        deadline = time.monotonic() + int(query.get("timeoutSeconds", ["300"])[0])
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        position = 0
+        try:
+            while time.monotonic() < deadline:
+                with self.condition:
+                    self.condition.wait_for(lambda : self.version > version, timeout=max(deadline - time.monotonic(), 0))
+                    events = self.events[position:]
+                    position = len(self.events)
+                for event_version, event_type, event_resource, event_namespace, obj in events:
+                    if event_version > version and event_resource == resource and selected(event_namespace, json.loads(obj)):
+                        line = ('{"type": "%s", "object": %s}\n' %(event_type, obj)).encode()
+                        handler.wfile.write(b"%x\r\n%s\r\n" %(len(line), line))
+                        version = event_version
+                if events:
+                    version = max(version, events[-1][0])
+                handler.wfile.flush()
+            handler.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def handler(self):
+        api = self
+        class KubernetesHandler(Handler):
+            def handle_method(self, method):
+                if api.latency:
+                    time.sleep(api.latency)
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                parts = url.path.strip("/").split("/")
+                parts = parts[2:] if parts[0] == "api" else parts[3:]
+                namespace = None
+                if parts[0] == "namespaces" and len(parts) > 2:
+                    namespace, parts = parts[1], parts[2:]
+                resource, name, subresource = (parts + [None, None])[:3]
+                if resource not in kinds:
+                    return self.send_json(404, {"kind": "Status", "status": "Failure", "reason": "NotFound", "code": 404})
+                if method == "GET" and name is None and query.get("watch", [""])[0] in ("true", "1"):
+                    return api.watch(self, resource, namespace, query)
+                if method == "GET" and name is None:
+                    return self.send_json(200, api.list(resource, namespace, query))
+                if method == "POST":
+                    return self.send_json(*api.store(resource, namespace, self.read_json()))
+                if method == "DELETE":
+                    return self.send_json(*api.delete(resource, namespace, name))
+                obj = api.objects.get((resource, namespace, name))
+                if not obj:
+                    return self.send_json(404, {"kind": "Status", "status": "Failure", "reason": "NotFound", "code": 404})
+                if subresource == "log":
+                    return self.send_text(200, "Starting the notebook\nJupyter Server 2.0.0 is running at:\nhttp://localhost:9999/lab\n")
+                self.send_json(200, obj)
+        return KubernetesHandler
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the fake Connect and Kubernetes APIs")
+    parser.add_argument("--namespace", default="af-jupyter")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--notebooks", type=int, default=200)
+    parser.add_argument("--user-notebooks", type=int, default=10)
+    parser.add_argument("--gpu-nodes", type=int, default=20)
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="seconds added to each Connect API call")
+    parser.add_argument("--kubernetes-latency", type=float, default=0.0, help="seconds added to each Kubernetes API call")
+    args = parser.parse_args()
+    connect = serve(ConnectAPI(args.users, args.groups, args.connect_latency).handler())
+    kubernetes = serve(KubernetesAPI(args.namespace, args.users, args.notebooks, args.user_notebooks, args.gpu_nodes, args.kubernetes_latency).handler())
+    print(json.dumps({"connect": connect.server_port, "kubernetes": kubernetes.server_port}), flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,56 @@
+# Micro-benchmark of the manifests built for each notebook deploy
+# It compares building a fresh Jinja environment and parsing with yaml.safe_load on every call (before)
+# with the templates compiled once in portal/manifests.py (after)
+#
+#   python benchmarks/manifests.py [number of deploys]
+
+import os
+import sys
+import time
+import yaml
+import importlib.util
+from jinja2 import Environment, FileSystemLoader
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Load portal/manifests.py by path, so the portal package and its configuration are not needed
+spec = importlib.util.spec_from_file_location("manifests", os.path.join(root, "portal", "manifests.py"))
+manifests = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(manifests)
+
+settings = {
+    "pod": dict(notebook_id="user-notebook-1", notebook_name="user-notebook-1", namespace="af-jupyter", username="user",
+        globus_id="00000000-0000-0000-0000-000000000000", token="dG9rZW4=", cpu_request=2, cpu_limit=4,
+        memory_request="8Gi", memory_limit="16Gi", gpu_request=1, gpu_limit=1, gpu_memory=40536,
+        image="hub.opensciencegrid.org/usatlas/ml-platform:latest", hours=72),
+    "service": dict(notebook_id="user-notebook-1", namespace="af-jupyter", image="hub.opensciencegrid.org/usatlas/ml-platform:latest"),
+    "ingress": dict(notebook_id="user-notebook-1", namespace="af-jupyter", domain_name="af.uchicago.edu", username="user",
+        image="hub.opensciencegrid.org/usatlas/ml-platform:latest"),
+    "secret": dict(notebook_id="user-notebook-1", namespace="af-jupyter", username="user", token="dG9rZW4="),
+}
+
+def build_before(kind, **kwargs):
+    templates = Environment(loader=FileSystemLoader(manifests.template_dir))
+    template = templates.get_template(kind + ".yaml")
+    return yaml.safe_load(template.render(**kwargs))
+
+def build_after(kind, **kwargs):
+    return manifests.build(kind, **kwargs)
+
+def measure(build, deploys):
+    start = time.perf_counter()
+    for i in range(deploys):
+        for kind, kwargs in settings.items():
+            build(kind, **kwargs)
+    return (time.perf_counter() - start) / deploys * 1000
+
+if __name__ == "__main__":
+    deploys = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for kind, kwargs in settings.items():
+        assert build_before(kind, **kwargs) == build_after(kind, **kwargs), kind
+    before = measure(build_before, deploys)
+    after = measure(build_after, deploys)
+    print("YAML loader: %s" %manifests.Loader.__name__)
+    print("before: %.3f ms per deploy" %before)
+    print("after:  %.3f ms per deploy" %after)
+    print("speedup: %.1fx" %(before / after))
@@ -0,0 +1,283 @@
+# Benchmarks the portal against local stand-ins for the Connect API and the Kubernetes API server (see fakes.py)
+# The fakes, the portal and the load generator run as separate processes on this machine, and nothing leaves it
+#
+#   python benchmarks/run.py [--users 2000] [--notebooks 200] [--duration 10] [--concurrency 8]
+#
+# Each run is appended to benchmarks/results.jsonl with the git commit it ran on,
+# and compared with the last recorded run that used the same settings
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import requests
+from datetime import datetime, timezone
+from flask import Flask
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+here = os.path.dirname(os.path.abspath(__file__))
+secret_key = "benchmark"
+username = "user00000"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_fakes(args):
+    command = [sys.executable, os.path.join(here, "fakes.py"), "--namespace", args.namespace, "--users", str(args.users),
+        "--groups", str(args.groups), "--notebooks", str(args.notebooks), "--user-notebooks", str(args.user_notebooks),
+        "--gpu-nodes", str(args.gpu_nodes), "--connect-latency", str(args.connect_latency), "--kubernetes-latency", str(args.kubernetes_latency)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    return process, json.loads(process.stdout.readline())
+
+def write_config(directory, ports, args):
+    kubeconfig = os.path.join(directory, "kubeconfig")
+    with open(kubeconfig, "w") as f:
+        json.dump({"apiVersion": "v1", "kind": "Config", "current-context": "benchmark",
+            "clusters": [{"name": "benchmark", "cluster": {"server": "http://127.0.0.1:%d" %ports["kubernetes"]}}],
+            "users": [{"name": "benchmark", "user": {}}],
+            "contexts": [{"name": "benchmark", "context": {"cluster": "benchmark", "user": "benchmark"}}]}, f)
+    config = os.path.join(directory, "portal.conf")
+    settings = {
+        "SECRET_KEY": secret_key,
+        "WTF_CSRF_ENABLED": False,
+        "CONNECT_API_ENDPOINT": "http://127.0.0.1:%d" %ports["connect"],
+        "CONNECT_API_TOKEN": "benchmark",
+        "NAMESPACE": args.namespace,
+        "DOMAIN_NAME": "af.example.org",
+        "CLIENT_ID": "benchmark",
+        "CLIENT_SECRET": "benchmark",
+        "KUBECONFIG": kubeconfig,
+        "PROFILE_STORE_PATH": os.path.join(directory, "profiles.db"),
+        "LEADER_LOCK_PATH": os.path.join(directory, "portal.lock")}
+    with open(config, "w") as f:
+        f.writelines("%s = %r\n" %(key, value) for key, value in settings.items())
+    return config
+
+def start_portal(directory, config, port):
+    env = dict(os.environ, PORTAL_CONFIG=config)
+    log = open(os.path.join(directory, "serve.log"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(here, "serve.py"), str(port)], cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+# Signs a session cookie the way the portal does, so requests arrive already logged in as the benchmark user
+def session_cookie():
+    signer = Flask(__name__)
+    signer.secret_key = secret_key
+    serializer = signer.session_interface.get_signing_serializer(signer)
+    return serializer.dumps({"is_authenticated": True, "unix_name": username, "globus_id": "00000000-0000-0000-0000-000000000000",
+        "name": "User 0", "email": "user00000@example.org", "institution": "Institution 0"})
+
+def new_session(base_url):
+    session = requests.Session()
+    session.cookies.set("session", session_cookie(), domain="127.0.0.1")
+    session.headers["Accept"] = "application/json"
+    session.base_url = base_url
+    return session
+
+def wait_until_ready(base_url, timeout=60):
+    session = new_session(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # The first request starts the informers, which are synced once the GPU nodes show up
+            if session.get(base_url + "/hardware/gpus", timeout=5).json().get("gpus"):
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise Exception("The portal was not ready within %d seconds" %timeout)
+
+run_id = "%x" %(int(time.time()) % 0xfffff)
+counter = itertools.count()
+
+def get_notebooks(session):
+    return session.get(session.base_url + "/jupyterlab/get_notebooks")
+
+def get_user_profiles(session):
+    return session.get(session.base_url + "/admin/get_user_profiles")
+
+def get_gpus(session):
+    return session.get(session.base_url + "/hardware/gpus")
+
+def deploy(session):
+    form = {"notebook-name": "bench-%s-%d" %(run_id, next(counter)), "cpu": 1, "memory": 2, "gpu": 0, "gpu-memory": 40536,
+        "image": "hub.opensciencegrid.org/usatlas/ml-platform:latest", "duration": 1}
+    resp = session.post(session.base_url + "/jupyterlab/deploy", data=form, allow_redirects=False)
+    if resp.status_code == 200:
+        session.jobs.append(resp.json()["job_id"])
+    return resp
+
+# Each endpoint runs for the whole duration, except deploys, which are capped so they do not fill the cluster
+endpoints = {
+    "/jupyterlab/get_notebooks": (get_notebooks, None),
+    "/admin/get_user_profiles": (get_user_profiles, None),
+    "/hardware/gpus": (get_gpus, None),
+    "/jupyterlab/deploy": (deploy, "max_deploys")}
+
+def is_ok(resp):
+    if resp.status_code != 200:
+        return False
+    return "error" not in resp.json()
+
+def run_load(base_url, request, duration, concurrency, max_requests=None):
+    latencies = []
+    errors = []
+    jobs = []
+    lock = threading.Lock()
+    budget = itertools.count()
+    deadline = time.monotonic() + duration
+    def worker():
+        session = new_session(base_url)
+        session.jobs = jobs
+        while time.monotonic() < deadline and (max_requests is None or next(budget) < max_requests):
+            start = time.perf_counter()
+            try:
+                ok = is_ok(request(session))
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors.append(elapsed)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(errors), time.perf_counter() - start, jobs
+
+# Follows each deploy job to the end, and returns how many of them succeeded
+def wait_for_jobs(base_url, jobs, timeout=120):
+    session = new_session(base_url)
+    succeeded = 0
+    deadline = time.monotonic() + timeout
+    for job_id in jobs:
+        state = "queued"
+        while state in ("queued", "running") and time.monotonic() < deadline:
+            state = session.get(base_url + "/jupyterlab/deploy/" + job_id).json()["state"]
+        succeeded += state == "succeeded"
+    return succeeded
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+def summarize(latencies, errors, elapsed):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None}
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(["git"] + list(args), cwd=root, capture_output=True, text=True).stdout.strip()
+    return {"commit": git("rev-parse", "--short", "HEAD"), "subject": git("log", "-1", "--format=%s"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def load_previous(path, settings):
+    previous = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["settings"] == settings:
+                    previous = entry
+    return previous
+
+def compare(entry, previous, threshold):
+    regressions = []
+    print("%-28s %10s %10s %10s %8s" %("endpoint", "req/s", "p50 ms", "p99 ms", "errors"))
+    for endpoint, result in entry["results"].items():
+        print("%-28s %10s %10s %10s %8s" %(endpoint, result["throughput"], result["p50_ms"], result["p99_ms"], result["errors"]))
+        if "jobs_succeeded" in result:
+            print("%28s %d of %d deploy jobs succeeded" %("", result["jobs_succeeded"], result["jobs_submitted"]))
+        before = (previous or {}).get("results", {}).get(endpoint)
+        if not before or not before["p50_ms"] or not result["p50_ms"]:
+            continue
+        changes = [
+            ("req/s", before["throughput"], result["throughput"], result["throughput"] < before["throughput"] * (1 - threshold)),
+            ("p50 ms", before["p50_ms"], result["p50_ms"], result["p50_ms"] > before["p50_ms"] * (1 + threshold)),
+            ("p99 ms", before["p99_ms"], result["p99_ms"], result["p99_ms"] > before["p99_ms"] * (1 + threshold))]
+        for name, old, new, regressed in changes:
+            print("%28s %s: %s -> %s (%+.1f%%)%s" %("", name, old, new, (new - old) / old * 100, "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append("%s %s" %(endpoint, name))
+    if previous:
+        print("Compared with %s (%s) from %s" %(previous["commit"], previous["subject"], previous["timestamp"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the portal against local fakes of the Connect and Kubernetes APIs")
+    parser.add_argument("--namespace", default="af-jupyter")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--notebooks", type=int, default=200)
+    parser.add_argument("--user-notebooks", type=int, default=10, help="notebooks owned by the benchmark user")
+    parser.add_argument("--gpu-nodes", type=int, default=20)
+    parser.add_argument("--connect-latency", type=float, default=0.005, help="seconds added to each Connect API call")
+    parser.add_argument("--kubernetes-latency", type=float, default=0.002, help="seconds added to each Kubernetes API call")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load on each endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-deploys", type=int, default=100)
+    parser.add_argument("--endpoints", nargs="+", default=list(endpoints), choices=list(endpoints))
+    parser.add_argument("--results", default=os.path.join(here, "results.jsonl"))
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    parser.add_argument("--no-record", action="store_true", help="compare with earlier runs without recording this one")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("results", "threshold", "no_record", "fail_on_regression")}
+    directory = tempfile.mkdtemp(prefix="portal-benchmark-")
+    fakes, ports = start_fakes(args)
+    port = free_port()
+    portal = start_portal(directory, write_config(directory, ports, args), port)
+    base_url = "http://127.0.0.1:%d" %port
+    results = dict()
+    try:
+        wait_until_ready(base_url)
+        for endpoint in args.endpoints:
+            request, limit = endpoints[endpoint]
+            # A few requests first, so caches and connection pools are warm, like on a server that has been up for a while
+            run_load(base_url, request, 1, 1, max_requests=3 if limit else None)
+            latencies, errors, elapsed, jobs = run_load(base_url, request, args.duration, args.concurrency, getattr(args, limit) if limit else None)
+            results[endpoint] = summarize(latencies, errors, elapsed)
+            if jobs:
+                # A deploy whose job fails is an error too, even though the request that queued it was accepted
+                succeeded = wait_for_jobs(base_url, jobs)
+                results[endpoint]["jobs_submitted"] = len(jobs)
+                results[endpoint]["jobs_succeeded"] = succeeded
+                results[endpoint]["errors"] += len(jobs) - succeeded
+    finally:
+        portal.terminate()
+        fakes.terminate()
+        portal.wait()
+        fakes.wait()
+
+    entry = dict(git_commit(), timestamp=datetime.now(timezone.utc).isoformat(timespec="seconds"), settings=settings, results=results)
+    regressions = compare(entry, load_previous(args.results, settings), args.threshold)
+    # A run with failed deploy jobs measured a failing path, so it is not kept as a baseline
+    failed_jobs = sum(result["jobs_submitted"] - result["jobs_succeeded"] for result in results.values() if "jobs_succeeded" in result)
+    if not args.no_record and not failed_jobs:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    print("Portal log: %s" %os.path.join(directory, "serve.log"))
+    if failed_jobs:
+        print("%d deploy jobs did not succeed, so this run was not recorded" %failed_jobs)
+        sys.exit(1)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
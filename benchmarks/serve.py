@@ -0,0 +1,14 @@
+# Serves the portal for the benchmark harness, using the configuration file named by PORTAL_CONFIG
+#
+#   PORTAL_CONFIG=/path/to/portal.conf python benchmarks/serve.py <port>
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import run_simple
+from portal import app
+
+if __name__ == "__main__":
+    run_simple("127.0.0.1", int(sys.argv[1]), app, threaded=True)
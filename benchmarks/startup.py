@@ -0,0 +1,81 @@
+# Reports how long importing the portal takes and how much memory a fresh worker holds afterwards
+# It runs `python -X importtime -c "import portal"` in new processes, so nothing is cached between runs
+#
+#   python benchmarks/startup.py [--runs 5] [--top 15] [--budget-ms 1000] [--budget-mb 120]
+#
+# With a budget, the script exits with status 1 when the median import time or the RSS is over it
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+heavy = ("matplotlib", "numpy", "kubernetes", "globus_sdk", "dateutil")
+
+probe = """
+import sys, time, json
+start = time.perf_counter()
+import portal
+elapsed = time.perf_counter() - start
+with open("/proc/self/status") as f:
+    rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+print(json.dumps({"import_ms": elapsed * 1000, "rss_kb": rss, "loaded": [name for name in %r if name in sys.modules]}))
+""" %(heavy,)
+
+# Enough configuration for the portal to import, without the secrets of a real deployment
+def write_config(directory):
+    config = os.path.join(directory, "portal.conf")
+    with open(config, "w") as f:
+        f.write("SECRET_KEY = 'startup'\nCONNECT_API_ENDPOINT = 'http://127.0.0.1:9'\nCONNECT_API_TOKEN = ''\n")
+        f.write("PROFILE_STORE_PATH = %r\nLEADER_LOCK_PATH = %r\n" %(os.path.join(directory, "profiles.db"), os.path.join(directory, "portal.lock")))
+    return config
+
+def run(config, directory):
+    env = dict(os.environ, PORTAL_CONFIG=config, PYTHONPATH=root)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise Exception(result.stderr)
+    modules = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "self [us]" not in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            modules.append((int(cumulative) / 1000, name.rstrip()))
+    return json.loads(result.stdout.splitlines()[-1]), modules
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports the import time and memory of a fresh portal worker")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to list")
+    parser.add_argument("--budget-ms", type=float, help="largest acceptable median import time")
+    parser.add_argument("--budget-mb", type=float, help="largest acceptable RSS after import")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="portal-startup-")
+    config = write_config(directory)
+    runs = [run(config, directory) for _ in range(args.runs)]
+    import_ms = statistics.median(summary["import_ms"] for summary, _ in runs)
+    rss_mb = statistics.median(summary["rss_kb"] for summary, _ in runs) / 1024
+    summary, modules = runs[-1]
+
+    print("Slowest imports (cumulative, last run):")
+    for cumulative, name in sorted(modules, reverse=True)[:args.top]:
+        print("  %8.1f ms  %s" %(cumulative, name))
+    print("Heavy packages loaded at import: %s" %(", ".join(summary["loaded"]) or "none"))
+    print("Import time: %.1f ms (median of %d)" %(import_ms, args.runs))
+    print("RSS after import: %.1f MB" %rss_mb)
+
+    over = []
+    if args.budget_ms is not None and import_ms > args.budget_ms:
+        over.append("import time %.1f ms is over the budget of %.1f ms" %(import_ms, args.budget_ms))
+    if args.budget_mb is not None and rss_mb > args.budget_mb:
+        over.append("RSS %.1f MB is over the budget of %.1f MB" %(rss_mb, args.budget_mb))
+    for message in over:
+        print("Over budget: %s" %message)
+    sys.exit(1 if over else 0)
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,18 @@ from flask import Flask
 from jinja2_markdown import MarkdownExtension
 from flask_wtf.csrf import CSRFProtect
 import logging
+import os
+from portal.logs import configure_logging
 
 app = Flask(__name__)
-app.config.from_pyfile("secrets/portal.conf")
+app.config.from_pyfile(os.environ.get("PORTAL_CONFIG", "secrets/portal.conf"))
 app.jinja_env.add_extension(MarkdownExtension)
 csrf = CSRFProtect(app)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s;%(module)s;%(funcName)s;%(levelname)s;%(message)s")
 logger.propagate = False
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-fh = logging.FileHandler("portal.log")
-fh.setLevel(logging.INFO)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+log_listener = configure_logging(app, logger)
 
-import portal.views
\ No newline at end of file
+import portal.views
+import portal.lifecycle
@@ -1,33 +1,62 @@
-import base64
-from matplotlib.figure import Figure
+import json
+import hashlib
 from io import BytesIO
-from datetime import datetime
-import pandas as pd
-from portal import app, logger, connect
+from datetime import datetime, timezone
+from portal import app, logger, connect, profile_store, lazy
 import requests
 
-def plot_users_over_time():
+np = lazy.load("numpy")
+figure = lazy.load("matplotlib.figure")
+
+# Rendered charts are kept until the data behind them changes
+charts = dict()
+
+def get_users_over_time(group_by=None, max_groups=10):
     usernames = connect.get_group_members("root.atlas-af")
-    users = connect.get_user_profiles(usernames, date_format=None)
-    datemin = datetime(2021, 7, 1)
-    datemax = datetime.today()
-    dates = pd.date_range(datemin, datemax, freq="MS").to_pydatetime().tolist()
-    xvalues = list(map(lambda d : d.strftime("%m-%Y"), dates))
-    yvalues = [0] * len(xvalues)
-    for i in range(len(dates)):
-        year = dates[i].year
-        month = dates[i].month
-        L = list(filter(lambda u : u["join_date"].year < year or (u["join_date"].year == year and u["join_date"].month <= month), users))
-        yvalues[i] = len(L)
-    fig = Figure(figsize=(15, 7), dpi=80, tight_layout=True)
+    users = profile_store.get_profiles(usernames, date_format=None)
+    # Months are counted from year 0, so each join date becomes a single integer
+    today = datetime.today()
+    months = np.arange(2021 * 12 + 6, today.year * 12 + today.month)
+    groups = dict()
+    for user in users:
+        label = (user[group_by] or "Unknown") if group_by else "All users"
+        groups.setdefault(label, []).append(user["join_date"].year * 12 + user["join_date"].month - 1)
+    labels = sorted(groups, key=lambda label : len(groups[label]), reverse=True)
+    if len(labels) > max_groups:
+        groups["Other"] = [month for label in labels[max_groups - 1:] for month in groups[label]]
+        labels = labels[:max_groups - 1] + ["Other"]
+    series = dict()
+    for label in labels:
+        join_months = np.sort(np.array(groups[label]))
+        series[label] = np.searchsorted(join_months, months, side="right").tolist()
+    return {
+        "months": ["%02d-%d" %(month % 12 + 1, month // 12) for month in months],
+        "series": series,
+        "group_by": group_by}
+
+def get_users_over_time_chart(group_by=None):
+    data = get_users_over_time(group_by)
+    etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    chart = charts.get(group_by)
+    if chart and chart["etag"] == etag:
+        return chart
+    chart = {"etag": etag, "last_modified": datetime.now(timezone.utc), "png": plot_users_over_time(data)}
+    charts[group_by] = chart
+    logger.info("Rendered users over time chart %s" %etag)
+    return chart
+
+def plot_users_over_time(data):
+    fig = figure.Figure(figsize=(15, 7), dpi=80, tight_layout=True)
     ax = fig.subplots()
-    ax.plot(xvalues, yvalues)
+    for label, yvalues in data["series"].items():
+        ax.plot(data["months"], yvalues, label=label)
     ax.set_xlabel("Month")
     ax.set_ylabel("Number of users")
+    if data["group_by"]:
+        ax.legend()
     buf = BytesIO()
     fig.savefig(buf, format="png")
-    data = base64.b64encode(buf.getbuffer()).decode("ascii")
-    return data
+    return buf.getvalue()
 
 def get_email_list(group):
     group_members = connect.get_group_members(group)
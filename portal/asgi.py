@@ -0,0 +1,187 @@
+# This module serves the notebook and hardware endpoints from asyncio, for an ASGI server such as uvicorn
+#
+#   uvicorn portal.asgi:app --host 127.0.0.1 --port 8081
+#
+# Notebook event streams wait on the event loop instead of holding a thread each, so one process can hold thousands of them.
+# The calls that still block, like reading a pod log or looking up a user's role in Connect, run on a small thread pool.
+# Deploy jobs live in the process that accepted them, so their status is left to the app that serves POST /jupyterlab/deploy
+# Other paths are served by the Flask app through asgiref when it is installed; otherwise the proxy should send them to uWSGI
+
+import re
+import json
+import time
+import asyncio
+import functools
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs, quote
+from concurrent.futures import ThreadPoolExecutor
+from itsdangerous import BadSignature
+from portal import app as flask_app, logger, connect, jupyterlab, notebook_events, lifecycle, metrics
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    fallback = WsgiToAsgi(flask_app)
+except ImportError:
+    fallback = None
+
+blocking_executor = ThreadPoolExecutor(max_workers=flask_app.config.get("ASGI_BLOCKING_WORKERS", 32))
+session_serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+session_max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+class Request:
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.path = scope["path"]
+        self.args = {key: values[0] for key, values in parse_qs(scope["query_string"].decode()).items()}
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+        self.session = self.get_session()
+        self.status = None
+
+    # Reads the Flask session cookie, so a user logged in through the Flask app is logged in here too
+    def get_session(self):
+        cookie = SimpleCookie(self.headers.get("cookie", "")).get(flask_app.config["SESSION_COOKIE_NAME"])
+        if not cookie:
+            return dict()
+        try:
+            return session_serializer.loads(cookie.value, max_age=session_max_age)
+        except BadSignature:
+            return dict()
+
+    async def start(self, status, content_type, headers=()):
+        self.status = status
+        headers = [(b"content-type", content_type.encode())] + [(name.encode(), value.encode()) for name, value in headers]
+        await self.send({"type": "http.response.start", "status": status, "headers": headers})
+
+    async def write(self, data, more=True):
+        await self.send({"type": "http.response.body", "body": data.encode() if isinstance(data, str) else data, "more_body": more})
+
+    async def respond(self, status, body, content_type, headers=()):
+        await self.start(status, content_type, headers)
+        await self.write(body, more=False)
+
+    async def respond_json(self, status=200, **body):
+        await self.respond(status, json.dumps(body), "application/json")
+
+async def run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, functools.partial(fn, *args))
+
+# The same checks as auth.members_only
+async def is_member(request):
+    if not request.session.get("is_authenticated"):
+        await request.respond(302, "", "text/plain", [("location", "/login?next=" + quote(request.path))])
+        return False
+    role = await run_blocking(connect.get_user_role, request.session["unix_name"])
+    if role not in ("admin", "active"):
+        await request.respond_json(403, error="You must be a member of the ATLAS Analysis Facility to use this page.")
+        return False
+    return True
+
+async def get_gpus(request):
+    try:
+        # Served from memory once the informers have synced, and from the API before that
+        gpus = await run_blocking(jupyterlab.get_gpus)
+        nodes = await run_blocking(jupyterlab.get_gpu_nodes)
+        await request.respond_json(gpus=gpus, nodes=nodes)
+    except Exception as err:
+        logger.error(str(err))
+        await request.respond_json(gpus=[], nodes=[], error="There was an error getting GPU product information.")
+
+async def get_notebooks(request):
+    if not await is_member(request):
+        return
+    try:
+        notebooks = await run_blocking(jupyterlab.get_notebooks, request.session["unix_name"])
+        await request.respond_json(notebooks=notebooks)
+    except Exception as err:
+        logger.error(str(err))
+        await request.respond_json(notebooks=[], error="There was an error getting user notebooks.")
+
+# Pod events arrive on an informer thread and are handed to the event loop of the stream
+class Subscription:
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, event_type):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event_type)
+
+async def get_notebook_events(request):
+    if not await is_member(request):
+        return
+    username = request.session["unix_name"]
+    loop = asyncio.get_running_loop()
+    subscription = Subscription(loop)
+    if not notebook_events.subscribe(username, subscription):
+        return await request.respond(204, "", "text/plain")
+    try:
+        await request.start(200, "text/event-stream", [("cache-control", "no-cache"), ("x-accel-buffering", "no")])
+        await request.write("retry: 2000\n\n")
+        sent = dict()
+        deadline = loop.time() + notebook_events.max_age
+        while loop.time() < deadline:
+            notebooks = await run_blocking(notebook_events.get_notebooks, username)
+            changes = notebook_events.get_changes(sent, notebooks)
+            for change in changes:
+                await request.write(change)
+            sent = notebooks
+            try:
+                await asyncio.wait_for(subscription.queue.get(), notebook_events.get_timeout(notebooks))
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+            except asyncio.TimeoutError:
+                if not changes:
+                    await request.write(": keep-alive\n\n")
+        await request.write("", more=False)
+    finally:
+        notebook_events.unsubscribe(username, subscription)
+
+# Each route is named by the Flask rule it stands in for
+routes = [
+    ("/hardware/gpus", re.compile(r"^/hardware/gpus$"), get_gpus),
+    ("/jupyterlab/get_notebooks", re.compile(r"^/jupyterlab/get_notebooks$"), get_notebooks),
+    ("/jupyterlab/events", re.compile(r"^/jupyterlab/events$"), get_notebook_events)]
+
+# Cancels a handler when its client goes away, so an abandoned stream does not run until it times out
+async def run_until_disconnect(request, handler, params):
+    task = asyncio.ensure_future(handler(request, **params))
+    async def watch():
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        task.cancel()
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        watcher.cancel()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await run_blocking(lifecycle.start_worker)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await run_blocking(lifecycle.shutdown)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+        for rule, pattern, handler in routes:
+            match = pattern.match(scope["path"])
+            if match:
+                start = time.perf_counter()
+                request = Request(scope, receive, send)
+                await run_until_disconnect(request, handler, match.groupdict())
+                metrics.request_seconds.observe(time.perf_counter() - start, endpoint=rule, method=scope["method"], status=request.status or 499)
+                return
+    if fallback:
+        return await fallback(scope, receive, send)
+    request = Request(scope, receive, send)
+    await request.respond(404, "This path is served by the WSGI app.", "text/plain")
@@ -0,0 +1,62 @@
+# This module has a small in-process cache whose entries expire after a time to live
+# Concurrent misses for the same key share a single call to the loader
+
+import time
+import threading
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.invalidated = False
+
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = dict()
+        self.flights = dict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = load(key)
+            return flight.value
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if not flight.error and not flight.invalidated:
+                    self.entries[key] = (flight.value, time.monotonic() + self.ttl)
+            flight.done.set()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.stats["invalidations"] += 1
+            self.entries.pop(key, None)
+            if key in self.flights:
+                self.flights[key].invalidated = True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            for flight in self.flights.values():
+                flight.invalidated = True
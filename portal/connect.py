@@ -1,22 +1,72 @@
 from portal import app, logger
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
 import requests
 import json
-from dateutil.parser import parse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from portal.cache import TTLCache
+from portal import metrics, tracing, lazy
 
+parser = lazy.load("dateutil.parser")
 base_url = app.config["CONNECT_API_ENDPOINT"]
 token = app.config["CONNECT_API_TOKEN"]
 params = {"token": token}
+role_cache = TTLCache(ttl=app.config.get("ROLE_CACHE_TTL", 60))
+invalidation_handlers = []
+metrics.register_stats("role_cache", role_cache.stats, "Role cache lookups, misses and invalidations")
+
+# A shared session keeps connections to the Connect API alive between requests
+# Only idempotent methods are retried, so a multiplex POST is never sent twice
+class ConnectSession(requests.Session):
+    def __init__(self, timeout, retries, pool_size):
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=("GET", "PUT", "DELETE", "HEAD", "OPTIONS"),
+            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        # Calls are labeled with the resource they touch, like users or groups, rather than the full path
+        path = url[len(base_url):].split("?")[0].strip("/").split("/")
+        operation = path[1] if len(path) > 1 else "other"
+        with tracing.span("Connect %s %s" %(method, operation), kind="client", **{"http.method": method, "http.url": url}) as span:
+            if span.traceparent():
+                kwargs["headers"] = dict(kwargs.get("headers") or {}, traceparent=span.traceparent())
+            with metrics.timer(metrics.connect_call_seconds, metrics.connect_call_errors, operation=operation, method=method):
+                resp = super().request(method, url, **kwargs)
+            span.set(**{"http.status_code": resp.status_code})
+        if resp.status_code >= 500:
+            metrics.connect_call_errors.inc(operation=operation, method=method)
+        return resp
+
+multiplex_chunk_size = app.config.get("MULTIPLEX_CHUNK_SIZE", 100)
+multiplex_retries = app.config.get("MULTIPLEX_RETRIES", 2)
+multiplex_executor = ThreadPoolExecutor(max_workers=app.config.get("MULTIPLEX_WORKERS", 8))
+
+session = ConnectSession(
+    timeout=(app.config.get("CONNECT_API_CONNECT_TIMEOUT", 3.05), app.config.get("CONNECT_API_READ_TIMEOUT", 30)),
+    retries=app.config.get("CONNECT_API_RETRIES", 3),
+    pool_size=app.config.get("CONNECT_API_POOL_SIZE", 20))
 
 def find_user(globus_id):
     params = {"token": token, "globus_id": globus_id}
-    resp = requests.get(base_url + "/v1alpha1/find_user", params=params).json()
+    resp = session.get(base_url + "/v1alpha1/find_user", params=params).json()
     if resp["kind"] == "User":
         return resp["metadata"]
     return None
 
 def get_user_profile(unix_name, date_format="%B %m %Y"):
-    resp = requests.get(base_url + "/v1alpha1/users/" + unix_name, params=params).json()
+    resp = session.get(base_url + "/v1alpha1/users/" + unix_name, params=params).json()
     if resp["kind"] == "User":
         profile = resp["metadata"]
         profile["join_date"] = datetime.strptime(profile["join_date"], "%Y-%b-%d %H:%M:%S.%f %Z").strftime(date_format)
@@ -27,23 +77,49 @@ def get_user_profile(unix_name, date_format="%B %m %Y"):
     return None
 
 def get_multiplex(json):
-    return requests.post(base_url + "/v1alpha1/multiplex", params=params, json=json).json()
+    return session.post(base_url + "/v1alpha1/multiplex", params=params, json=json).json()
 
 def get_user_profiles(usernames, date_format="%B %m %Y"):
     profiles = []
+    usernames = list(usernames)
+    chunks = [usernames[i:i + multiplex_chunk_size] for i in range(0, len(usernames), multiplex_chunk_size)]
+    futures = [multiplex_executor.submit(tracing.in_context(get_user_profiles_chunk), chunk, date_format) for chunk in chunks]
+    failures = 0
+    for future in as_completed(futures):
+        try:
+            profiles.extend(future.result())
+        except Exception as err:
+            failures += 1
+            logger.error(str(err))
+    if failures and failures == len(chunks):
+        raise Exception("Error getting user profiles")
+    return profiles
+
+def get_user_profiles_chunk(usernames, date_format):
     multiplex = {}
     for username in usernames:
         multiplex["/v1alpha1/users/" + username + "?token=" + token] = {"method": "GET"}
-    resp = requests.post(base_url + "/v1alpha1/multiplex", params=params, json=multiplex)
-    if resp.status_code != 200:
-        raise Exception("Error getting user profiles")
+    for attempt in range(multiplex_retries + 1):
+        if attempt:
+            time.sleep(0.5 * 2 ** (attempt - 1))
+        try:
+            resp = session.post(base_url + "/v1alpha1/multiplex", params=params, json=multiplex)
+            if resp.status_code == 200:
+                break
+        except requests.RequestException as err:
+            logger.warning("Multiplex request for %d users failed: %s" %(len(usernames), str(err)))
+    else:
+        raise Exception("Error getting user profiles for %d users starting with %s" %(len(usernames), usernames[0]))
+    profiles = []
     resp = resp.json()
     for entry in resp:
+        if resp[entry]["status"] != 200:
+            continue
         data = json.loads(resp[entry]["body"])["metadata"]
         username = data["unix_name"]
         email = data["email"]
         phone = data["phone"]
-        join_date = parse(data["join_date"]).strftime(date_format) if date_format else parse(data["join_date"]) 
+        join_date = parser.parse(data["join_date"]).strftime(date_format) if date_format else parser.parse(data["join_date"]) 
         institution = data["institution"]
         name = data["name"]
         group = list(filter(lambda group : group["name"] == "root.atlas-af", data["group_memberships"]))
@@ -52,15 +128,23 @@ def get_user_profiles(usernames, date_format="%B %m %Y"):
             role = group[0]["state"]
         profile = {"username": username, "email": email, "phone": phone, "join_date": join_date, "institution": institution, "name": name, "role": role}
         profiles.append(profile)
-    return profiles 
+    return profiles
 
 def get_user_role(unix_name):
+    return role_cache.get(unix_name, load_user_role)
+
+def load_user_role(unix_name):
     profile = get_user_profile(unix_name)
     group = list(filter(lambda group : group["name"] == "root.atlas-af", profile["group_memberships"]))
     if len(group) == 0:
         return "nonmember"
     return group[0]["state"]
 
+def invalidate_user(unix_name):
+    role_cache.invalidate(unix_name)
+    for handler in invalidation_handlers:
+        handler(unix_name)
+
 def update_user_profile(unix_name, **kwargs):
     json = {
         "apiVersion": "v1alpha1",
@@ -73,7 +157,8 @@ def update_user_profile(unix_name, **kwargs):
             "X.509_DN": kwargs["x509_dn"]
         }
     }
-    resp = requests.put(base_url + "/v1alpha1/users/" + unix_name, params=params, json=json)
+    resp = session.put(base_url + "/v1alpha1/users/" + unix_name, params=params, json=json)
+    invalidate_user(unix_name)
     if resp.status_code == requests.codes.ok:
         logger.info("Updated profile for user %s." %unix_name)
         return True
@@ -81,7 +166,8 @@ def update_user_profile(unix_name, **kwargs):
 
 def update_user_institution(unix_name, institution):
     json = {'apiVersion': 'v1alpha1', 'kind': 'User', 'metadata': {'institution': institution}}
-    resp = requests.put(base_url + "/v1alpha1/users/" + unix_name, params=params, json=json)
+    resp = session.put(base_url + "/v1alpha1/users/" + unix_name, params=params, json=json)
+    invalidate_user(unix_name)
     if resp.status_code == requests.codes.ok:
         logger.info("Updated user %s. Set institution to %s." %(unix_name, institution))
         return True
@@ -111,18 +197,18 @@ def get_user_groups(unix_name):
     return groups
 
 def get_group_info(group_name, date_format="%B %m %Y"):
-    resp = requests.get(base_url + "/v1alpha1/groups/" + group_name, params=params)
+    resp = session.get(base_url + "/v1alpha1/groups/" + group_name, params=params)
     if resp.status_code != 200:
         raise Exception("Error getting info for group %s" %group_name)
     group = resp.json()["metadata"]
     group["pending"] = str(group["pending"])
-    group["creation_date"] = parse(group["creation_date"]).strftime(date_format)
+    group["creation_date"] = parser.parse(group["creation_date"]).strftime(date_format)
     group["is_deletable"] = is_group_deletable(group_name)
     return group
 
 def get_group_members(group_name, states=["admin", "active", "pending"]):
     usernames = []
-    resp = requests.get(base_url + "/v1alpha1/groups/" + group_name + "/members", params=params)
+    resp = session.get(base_url + "/v1alpha1/groups/" + group_name + "/members", params=params)
     if resp.status_code != 200:
         raise Exception("Error getting members for group %s" %group_name)
     for entry in resp.json()["memberships"]:
@@ -132,14 +218,14 @@ def get_group_members(group_name, states=["admin", "active", "pending"]):
     return usernames
 
 def get_subgroups(group_name):
-    resp = requests.get(base_url + "/v1alpha1/groups/" + group_name + "/subgroups", params=params)
+    resp = session.get(base_url + "/v1alpha1/groups/" + group_name + "/subgroups", params=params)
     if resp.status_code != 200:
         raise Exception("Error getting group %s" %group_name)
     subgroups = resp.json()["groups"]
     return subgroups
 
 def get_subgroup_requests(group_name):
-    resp = requests.get(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests", params=params)
+    resp = session.get(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests", params=params)
     if resp.status_code != 200:
         raise Exception("Error getting group %s" %group_name)
     subgroups = resp.json()["groups"]
@@ -147,7 +233,8 @@ def get_subgroup_requests(group_name):
 
 def update_user_group_status(unix_name, group_name, status):
     json = {"apiVersion": "v1alpha1", "group_membership": {"state": status}}
-    resp = requests.put(base_url + "/v1alpha1/groups/" + group_name + "/members/" + unix_name, params=params, json=json)
+    resp = session.put(base_url + "/v1alpha1/groups/" + group_name + "/members/" + unix_name, params=params, json=json)
+    invalidate_user(unix_name)
     if resp.status_code == requests.codes.ok:
         logger.info("Set status to %s in group %s for user %s" %(status, group_name, unix_name))
         return True
@@ -155,14 +242,16 @@ def update_user_group_status(unix_name, group_name, status):
 
 def add_user_to_group(unix_name, group_name):
     json = {"apiVersion": "v1alpha1", "group_membership": {"state": "active"}}
-    resp = requests.put(base_url + "/v1alpha1/groups/" + group_name + "/members/" + unix_name, params=params, json=json)
+    resp = session.put(base_url + "/v1alpha1/groups/" + group_name + "/members/" + unix_name, params=params, json=json)
+    invalidate_user(unix_name)
     if resp.status_code == requests.codes.ok:
         logger.info("Added user %s to group %s" %(unix_name, group_name))
         return True
     return False
 
 def remove_user_from_group(unix_name, group_name):
-    resp = requests.delete(base_url + "/v1alpha1/groups/" + group_name + "/members/" + unix_name, params=params)
+    resp = session.delete(base_url + "/v1alpha1/groups/" + group_name + "/members/" + unix_name, params=params)
+    invalidate_user(unix_name)
     if resp.status_code == requests.codes.ok:
         logger.info("Removed user %s from group %s" %(unix_name, group_name))
         return True
@@ -180,20 +269,20 @@ def create_subgroup(subgroup_name, group_name, **kwargs):
             "description": kwargs["description"]
         }
     }
-    resp = requests.put(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests/" + subgroup_name, params=params, json=json)
+    resp = session.put(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests/" + subgroup_name, params=params, json=json)
     if resp.status_code == requests.codes.ok:
         return True
     return False
 
 def approve_subgroup_request(subgroup_name, group_name):
-    resp = requests.put(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests/" + subgroup_name + "/approve", params=params)
+    resp = session.put(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests/" + subgroup_name + "/approve", params=params)
     if resp.status_code == requests.codes.ok:
         logger.info("Approved request for subgroup %s in group %s" %(subgroup_name, group_name))
         return True
     return False
 
 def deny_subgroup_request(subgroup_name, group_name):
-    resp = requests.delete(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests/" + subgroup_name, params=params)
+    resp = session.delete(base_url + "/v1alpha1/groups/" + group_name + "/subgroup_requests/" + subgroup_name, params=params)
     if resp.status_code == requests.codes.ok:
         logger.info("Denied request for subgroup %s in group %s" %(subgroup_name, group_name))
         return True
@@ -209,7 +298,7 @@ def update_group_info(group_name, **kwargs):
             "description": kwargs["description"],
         }
     }
-    resp = requests.put(base_url + "/v1alpha1/groups/" + group_name, params=params, json=json)
+    resp = session.put(base_url + "/v1alpha1/groups/" + group_name, params=params, json=json)
     if resp.status_code == requests.codes.ok:
         return True
     return False
@@ -230,7 +319,7 @@ def is_group_deletable(group_name):
 def delete_group(group_name):
     if is_group_deletable(group_name):
         try:
-            resp = requests.delete(base_url + "/v1alpha1/groups/" + group_name, params=params)
+            resp = session.delete(base_url + "/v1alpha1/groups/" + group_name, params=params)
             return resp.status_code == requests.codes.ok
         except Exception as err:
             logger.info(str(err))
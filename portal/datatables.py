@@ -0,0 +1,20 @@
+# This module handles the server side processing protocol of DataTables
+# The browser sends the page, sort order and search text, and gets back only the rows on the page
+
+def is_server_side(args):
+    return "draw" in args
+
+def get_params(args, columns):
+    order_column = args.get("order[0][column]", type=int)
+    order_by = args.get("columns[%d][data]" %order_column) if order_column is not None else None
+    return {
+        "start": max(args.get("start", 0, type=int), 0),
+        "length": args.get("length", 10, type=int),
+        "search": args.get("search[value]", "").strip(),
+        "order_by": order_by if order_by in columns else None,
+        "descending": args.get("order[0][dir]") == "desc"}
+
+def get_response(args, key, total, filtered, rows, **kwargs):
+    response = {"draw": args.get("draw", 0, type=int), "recordsTotal": total, "recordsFiltered": filtered, key: rows}
+    response.update(kwargs)
+    return response
@@ -0,0 +1,103 @@
+# This module removes notebooks when they expire
+# Expiration dates are read from the time2delete label of pods seen by the pod informer and kept in a min-heap
+# A single thread sleeps until the earliest date; it runs only in the leader process (see lifecycle.py)
+
+import time
+import heapq
+import threading
+from portal import logger, jupyterlab, metrics
+
+retry_interval = 60
+# The sweeping thread this replaces ran every 30 minutes, so on average it removed a notebook 15 minutes late
+# estimated_gpu_hours_reclaimed compares each removal with that average, not with when the sweep would really have run;
+# a removal later than the average counts as nothing reclaimed
+sweep_delay = 900
+
+class ExpirationScheduler:
+    def __init__(self, remove):
+        self.remove = remove
+        self.heap = []
+        self.deadlines = dict()
+        # Pods being removed or waiting to retry a removal, which pod events must not reschedule
+        self.claimed = set()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.stats = {"notebooks_expired": 0, "removal_errors": 0, "gpus_reclaimed": 0, "estimated_gpu_hours_reclaimed": 0.0, "expiration_lag_seconds": 0.0}
+
+    def on_pod(self, event_type, pod):
+        labels = pod.metadata.labels or {}
+        if labels.get("k8s-app") != "jupyterlab":
+            return
+        uid = pod.metadata.uid
+        with self.condition:
+            if event_type == "DELETED" or pod.metadata.deletion_timestamp:
+                self.deadlines.pop(uid, None)
+                self.claimed.discard(uid)
+                return
+            if uid in self.claimed:
+                return
+            expiration_date = jupyterlab.get_expiration_date(pod)
+            if expiration_date:
+                self.schedule(uid, pod.metadata.name, expiration_date.timestamp(), jupyterlab.get_requests(pod).get("gpu", 0))
+
+    def schedule(self, uid, name, deadline, gpus):
+        if self.deadlines.get(uid) != deadline:
+            self.deadlines[uid] = deadline
+            heapq.heappush(self.heap, (deadline, uid, name, gpus))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Entries whose pod was deleted or rescheduled are dropped when they reach the top of the heap
+                while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+                if self.stopped:
+                    return
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                deadline, uid, name, gpus = heapq.heappop(self.heap)
+                del self.deadlines[uid]
+                self.claimed.add(uid)
+            self.expire(deadline, uid, name, gpus)
+
+    def expire(self, deadline, uid, name, gpus):
+        logger.info("Notebook %s has expired" %name)
+        try:
+            deleted = self.remove(name)
+        except Exception as err:
+            logger.error("Unable to remove expired notebook %s: %s" %(name, str(err)))
+            self.stats["removal_errors"] += 1
+            with self.condition:
+                # Unless the pod was deleted meanwhile
+                if uid in self.claimed:
+                    self.schedule(uid, name, time.time() + retry_interval, gpus)
+            return
+        if not deleted:
+            # The pod was already gone, so no event will release it
+            with self.condition:
+                self.claimed.discard(uid)
+            return
+        lag = time.time() - deadline
+        self.stats["notebooks_expired"] += 1
+        self.stats["gpus_reclaimed"] += gpus
+        self.stats["estimated_gpu_hours_reclaimed"] += gpus * max(sweep_delay - lag, 0) / 3600
+        self.stats["expiration_lag_seconds"] += lag
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+scheduler = ExpirationScheduler(jupyterlab.remove_notebook)
+jupyterlab.pods.add_handler(scheduler.on_pod)
+metrics.register_stats("expiration", scheduler.stats, "Notebooks removed by the expiration scheduler, and GPU hours estimated to be freed sooner than by the old sweep")
+
+def start_expiration_scheduler():
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    logger.info("Started notebook expiration scheduler")
@@ -0,0 +1,93 @@
+# This module keeps a count of the GPUs in the cluster, grouped by GPU memory
+# It is updated from node and pod informer events, so lookups never call the Kubernetes API
+
+import threading
+
+def get_gpu_request(pod):
+    def request(container):
+        requests = container.resources.requests if container.resources else None
+        return int(requests.get("nvidia.com/gpu", 0)) if requests else 0
+    containers = sum(request(container) for container in pod.spec.containers or [])
+    init_containers = max((request(container) for container in pod.spec.init_containers or []), default=0)
+    return max(containers, init_containers)
+
+def get_gpu_labels(node):
+    labels = node.metadata.labels or {}
+    if "nvidia.com/gpu.memory" not in labels:
+        return None
+    return (labels["nvidia.com/gpu.product"], int(labels["nvidia.com/gpu.memory"]), int(labels["nvidia.com/gpu.count"]))
+
+class GPUIndex:
+    def __init__(self):
+        self.nodes = dict()
+        self.node_requests = dict()
+        self.pod_requests = dict()
+        self.gpus = dict()
+        self.lock = threading.Lock()
+
+    def get(self, memory):
+        with self.lock:
+            gpu = self.gpus.get(int(memory))
+            return self.summarize(gpu) if gpu else dict()
+
+    def list(self):
+        with self.lock:
+            return [self.summarize(self.gpus[memory]) for memory in sorted(self.gpus)]
+
+    # The GPU labels of one node, or None when the node is not in the index
+    def node(self, name):
+        with self.lock:
+            return self.summarize_node(name) if name in self.nodes else None
+
+    # Node names are left out, since the hardware page that shows these is public
+    def list_nodes(self):
+        with self.lock:
+            return [self.summarize_node(name) for name in sorted(self.nodes, key=lambda name : (self.nodes[name][1], name))]
+
+    def summarize_node(self, name):
+        product, memory, count = self.nodes[name]
+        return {"product": product, "memory": memory, "count": count, "available": max(count - self.node_requests.get(name, 0), 0)}
+
+    def summarize(self, gpu):
+        return {"product": gpu["product"], "memory": gpu["memory"], "count": gpu["count"], "available": max(gpu["count"] - gpu["requested"], 0)}
+
+    def on_node(self, event_type, node):
+        name = node.metadata.name
+        with self.lock:
+            if name in self.nodes:
+                product, memory, count = self.nodes.pop(name)
+                gpu = self.gpus[memory]
+                gpu["count"] -= count
+                gpu["requested"] -= self.node_requests.get(name, 0)
+                gpu["nodes"] -= 1
+                if gpu["nodes"] == 0:
+                    del self.gpus[memory]
+            gpu_labels = get_gpu_labels(node)
+            if event_type == "DELETED" or not gpu_labels:
+                return
+            product, memory, count = self.nodes[name] = gpu_labels
+            gpu = self.gpus.setdefault(memory, {"product": product, "memory": memory, "count": 0, "requested": 0, "nodes": 0})
+            gpu["count"] += count
+            gpu["requested"] += self.node_requests.get(name, 0)
+            gpu["nodes"] += 1
+
+    def on_pod(self, event_type, pod):
+        uid = pod.metadata.uid
+        with self.lock:
+            if uid in self.pod_requests:
+                node_name, gpus = self.pod_requests.pop(uid)
+                self.add_request(node_name, -gpus)
+            if event_type == "DELETED" or not pod.spec.node_name:
+                return
+            gpus = get_gpu_request(pod)
+            if gpus:
+                self.pod_requests[uid] = (pod.spec.node_name, gpus)
+                self.add_request(pod.spec.node_name, gpus)
+
+    def add_request(self, node_name, gpus):
+        self.node_requests[node_name] = self.node_requests.get(node_name, 0) + gpus
+        if self.node_requests[node_name] == 0:
+            del self.node_requests[node_name]
+        if node_name in self.nodes:
+            memory = self.nodes[node_name][1]
+            self.gpus[memory]["requested"] += gpus
@@ -0,0 +1,137 @@
+# This module keeps in-memory copies of Kubernetes objects
+# An informer lists a resource once, then follows a watch stream and resumes it from the last resourceVersion
+
+import threading
+from portal import logger, metrics, lazy
+
+client = lazy.load("kubernetes.client")
+watch = lazy.load("kubernetes.watch")
+
+# The API class is given by its name in kubernetes.client, so the client is not imported until the informer starts
+class Informer:
+    def __init__(self, api_class, list_method, *args, key=lambda obj : obj.metadata.name, indexes=(), **kwargs):
+        self.api_class = api_class
+        self.list_method = list_method
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.indexes = {label: dict() for label in indexes}
+        self.objects = dict()
+        self.handlers = []
+        self.resource_version = None
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Returns without waiting for the first list; until it has synced, list() reads from the API
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def get(self, key):
+        return self.objects.get(key)
+
+    # Until the first list has succeeded, readers go to the API, so a failed start raises instead of looking empty
+    def list(self, label=None, value=None):
+        if not self.synced.is_set():
+            return self.list_from_api(label, value)
+        with self.lock:
+            if label:
+                keys = self.indexes[label].get(value, ())
+                return [self.objects[key] for key in keys]
+            return list(self.objects.values())
+
+    def list_from_api(self, label=None, value=None):
+        kwargs = dict(self.kwargs)
+        if label:
+            kwargs["label_selector"] = ",".join(filter(None, (kwargs.get("label_selector"), "%s=%s" %(label, value))))
+        list_fn = getattr(getattr(client, self.api_class)(), self.list_method)
+        with metrics.timer(metrics.kubernetes_call_seconds, metrics.kubernetes_call_errors, operation=self.list_method):
+            return list_fn(*self.args, **kwargs).items
+
+    def run(self):
+        list_fn = getattr(getattr(client, self.api_class)(), self.list_method)
+        while not self.stopped.is_set():
+            try:
+                if self.resource_version is None:
+                    self.relist(list_fn)
+                stream = watch.Watch().stream(list_fn, *self.args, resource_version=self.resource_version, timeout_seconds=300, **self.kwargs)
+                for event in stream:
+                    if event["type"] == "ERROR":
+                        if event["raw_object"].get("code") == 410:
+                            self.resource_version = None
+                            break
+                        continue
+                    self.update(event["type"], event["object"])
+                    if self.stopped.is_set():
+                        break
+            except client.ApiException as err:
+                if err.status == 410:
+                    self.resource_version = None
+                else:
+                    logger.error("Watch on %s failed: %s" %(self.list_method, str(err)))
+                    self.stopped.wait(5)
+            except Exception as err:
+                logger.error("Watch on %s failed: %s" %(self.list_method, str(err)))
+                self.stopped.wait(5)
+
+    def relist(self, list_fn):
+        with metrics.timer(metrics.kubernetes_call_seconds, metrics.kubernetes_call_errors, operation=self.list_method):
+            resp = list_fn(*self.args, **self.kwargs)
+        objects = {self.key(obj): obj for obj in resp.items}
+        with self.lock:
+            removed = [obj for key, obj in self.objects.items() if key not in objects]
+            self.objects = dict()
+            for index in self.indexes.values():
+                index.clear()
+            for obj in objects.values():
+                self.store(obj)
+            self.resource_version = resp.metadata.resource_version
+        for obj in removed:
+            self.notify("DELETED", obj)
+        for obj in objects.values():
+            self.notify("ADDED", obj)
+        self.synced.set()
+        logger.info("Informer for %s synced %d objects" %(self.list_method, len(objects)))
+
+    def update(self, event_type, obj):
+        with self.lock:
+            self.discard(self.key(obj))
+            if event_type != "DELETED":
+                self.store(obj)
+            self.resource_version = obj.metadata.resource_version
+        self.notify(event_type, obj)
+
+    def store(self, obj):
+        key = self.key(obj)
+        self.objects[key] = obj
+        labels = obj.metadata.labels or {}
+        for label, index in self.indexes.items():
+            if label in labels:
+                index.setdefault(labels[label], set()).add(key)
+
+    def discard(self, key):
+        obj = self.objects.pop(key, None)
+        if obj:
+            labels = obj.metadata.labels or {}
+            for label, index in self.indexes.items():
+                keys = index.get(labels.get(label))
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del index[labels[label]]
+
+    def notify(self, event_type, obj):
+        for handler in self.handlers:
+            try:
+                handler(event_type, obj)
+            except Exception as err:
+                logger.error("Informer handler failed: %s" %str(err))
@@ -0,0 +1,90 @@
+# This module runs slow work, like deploying a notebook, outside of the request that asked for it
+# Jobs wait in a bounded queue for a small pool of worker threads, and report their progress as they run
+
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from portal import logger, tracing
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, owner):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.state = "queued"
+        self.progress = "Waiting to start..."
+        self.error = None
+        self.finished_at = None
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def update(self, state=None, progress=None, error=None):
+        with self.condition:
+            self.state = state or self.state
+            self.progress = progress or self.progress
+            self.error = error or self.error
+            if self.state in ("succeeded", "failed"):
+                self.finished_at = time.time()
+            self.version += 1
+            self.condition.notify_all()
+
+    def report(self, progress):
+        self.update(progress=progress)
+
+    def wait(self, version, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda : self.version != version or self.finished_at, timeout)
+
+    def to_dict(self):
+        with self.condition:
+            return {"job_id": self.id, "state": self.state, "progress": self.progress, "error": self.error, "version": self.version}
+
+class JobQueue:
+    def __init__(self, workers, max_pending, ttl=600):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = dict()
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, owner, fn, *args, expected_errors=(), **kwargs):
+        with self.lock:
+            self.expire()
+            if self.pending >= self.max_pending:
+                raise JobQueueFull("There are %d jobs waiting to run" %self.pending)
+            self.pending += 1
+            job = Job(owner)
+            self.jobs[job.id] = job
+        self.executor.submit(self.run, job, fn, args, kwargs, expected_errors, tracing.current_span.get())
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def run(self, job, fn, args, kwargs, expected_errors, follows=None):
+        try:
+            job.update(state="running", progress="Starting...")
+            # The job is traced on its own, linked to the request that submitted it
+            with tracing.trace("Job %s" %fn.__name__, follows=follows, **{"job.id": job.id}):
+                fn(*args, progress=job.report, **kwargs)
+            job.update(state="succeeded", progress="Done")
+        except expected_errors as err:
+            job.update(state="failed", error=str(err))
+        except Exception as err:
+            logger.error(str(err))
+            job.update(state="failed", error="There was an unexpected error.")
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def expire(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and now - job.finished_at > self.ttl]:
+            del self.jobs[job_id]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
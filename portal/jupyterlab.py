@@ -1,28 +1,61 @@
 # This module supports the JupyterLab service
 # It has a main interface near the top, and helper functions below the main interface
 
-import yaml
 import time
 import datetime
-import threading
 import os
 import re
 import string
 import urllib
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import timezone
-from jinja2 import Environment, FileSystemLoader
-from kubernetes import client, config
-from portal import app, logger
+from portal import app, logger, manifests, metrics, tracing, lazy
+from portal.informer import Informer
+from portal.readiness import ReadinessTracker
+from portal.gpu_index import GPUIndex, get_gpu_labels
+from portal.jobs import JobQueue
+from portal.cache import TTLCache
+
+client = lazy.load("kubernetes.client")
+config = lazy.load("kubernetes.config")
 
 config_file = app.config.get("KUBECONFIG")
 namespace = app.config.get("NAMESPACE")
 domain_name = app.config.get("DOMAIN_NAME")
+enrichment_deadline = app.config.get("NOTEBOOK_ENRICHMENT_DEADLINE", 5)
+executor = ThreadPoolExecutor(max_workers=app.config.get("NOTEBOOK_ENRICHMENT_WORKERS", 16))
+orchestration_executor = ThreadPoolExecutor(max_workers=app.config.get("NOTEBOOK_ORCHESTRATION_WORKERS", 16))
+rollback_attempts = app.config.get("ROLLBACK_ATTEMPTS", 3)
+rollback_retry_delay = app.config.get("ROLLBACK_RETRY_DELAY", 1)
+deploys = JobQueue(workers=app.config.get("DEPLOY_WORKERS", 4), max_pending=app.config.get("DEPLOY_QUEUE_SIZE", 100))
+
+pods = Informer("CoreV1Api", "list_namespaced_pod", namespace, label_selector="k8s-app in (jupyterlab, privatejupyter)", indexes=("owner", "notebook-id"))
+nodes = Informer("CoreV1Api", "list_node", label_selector="gpu=true")
+scheduled_pods = Informer("CoreV1Api", "list_pod_for_all_namespaces", field_selector="status.phase!=Succeeded,status.phase!=Failed", key=lambda pod : pod.metadata.uid)
+readiness = ReadinessTracker(namespace)
+gpu_index = GPUIndex()
+# GPU labels of nodes outside the node informer, such as a GPU node without the gpu=true label
+node_labels = TTLCache(ttl=app.config.get("NODE_CACHE_TTL", 600))
+# The access URL of a notebook never changes, so it is kept by pod uid from when the notebook is created or first listed
+urls = dict()
+url_stats = {"hits": 0, "misses": 0}
+
+def forget_deleted_pod(event_type, pod):
+    if event_type == "DELETED":
+        readiness.forget(pod.metadata.uid)
+        urls.pop(pod.metadata.uid, None)
+
+pods.add_handler(forget_deleted_pod)
+metrics.register_stats("readiness", readiness.stats, "Pod log reads made and avoided by the readiness tracker")
+metrics.register_stats("node_labels", node_labels.stats, "Lookups of GPU labels for nodes outside the node informer")
+metrics.register_stats("notebook_urls", url_stats, "Notebook URL lookups served from memory and read from the API")
+nodes.add_handler(gpu_index.on_node)
+scheduled_pods.add_handler(gpu_index.on_pod)
 
 class JupyterLabException(Exception):
     pass
 
-@app.before_first_request
 def load_kube_config():
     if config_file:
         config.load_kube_config(config_file=config_file)
@@ -31,60 +64,69 @@ def load_kube_config():
         config.load_kube_config()
         logger.info("Loaded default kubeconfig file")
 
-@app.before_first_request
-def start_notebook_maintenance():
-    def clean():
-        while True:
-            api = client.CoreV1Api()
-            pods = api.list_namespaced_pod(namespace, label_selector="k8s-app=jupyterlab").items
-            for pod in pods:
-                notebook_name = pod.metadata.name
-                exp_date = get_expiration_date(pod)
-                now = datetime.datetime.now(timezone.utc)
-                if exp_date and exp_date < now:
-                    logger.info("Notebook %s has expired" %notebook_name)
-                    remove_notebook(notebook_name)                        
-            time.sleep(1800)
-    threading.Thread(target=clean).start()
-    logger.info("Started notebook maintenance")
+def start_informers():
+    for informer in (pods, nodes, scheduled_pods):
+        informer.start()
+    logger.info("Started informers for namespace %s" %namespace)
+
+def stop_informers():
+    for informer in (pods, nodes, scheduled_pods):
+        informer.stop()
+
+def core_v1_api():
+    return metrics.instrument(client.CoreV1Api())
+
+def networking_v1_api():
+    return metrics.instrument(client.NetworkingV1Api())
 
 # The main interface of the module
-def create_notebook(notebook_name, **kwargs):
-    validate(notebook_name, **kwargs)
+# The caller validates the settings first, so that errors reach the user with the request that made them
+def create_notebook(notebook_name, progress=lambda message : None, **kwargs):
     token_bytes = os.urandom(32)
     kwargs["token"] = b64encode(token_bytes).decode()
-    create_pod(notebook_name, **kwargs)
-    create_service(notebook_name, **kwargs)
-    create_ingress(notebook_name, **kwargs)
-    create_secret(notebook_name, **kwargs)
-    logger.info("Created notebook %s" %notebook_name)
+    progress("Creating notebook %s..." %notebook_name)
+    outcomes = run_steps({
+        "pod": lambda : create_pod(notebook_name, **kwargs),
+        "service": lambda : create_service(notebook_name, **kwargs),
+        "ingress": lambda : create_ingress(notebook_name, **kwargs),
+        "secret": lambda : create_secret(notebook_name, **kwargs)})
+    errors = [outcome[1] for outcome in outcomes.values() if outcome[1]]
+    if errors:
+        for kind, outcome in outcomes.items():
+            if outcome[1]:
+                logger.error("Unable to create %s for notebook %s: %s" %(kind, notebook_name, str(outcome[1])))
+        created = [kind for kind, outcome in outcomes.items() if not outcome[1]]
+        remaining = roll_back(notebook_name.lower(), created)
+        if remaining:
+            logger.error("Unable to create notebook %s, and could not roll back %s" %(notebook_name, ", ".join(remaining)))
+        else:
+            logger.error("Unable to create notebook %s, rolled back %s" %(notebook_name, ", ".join(created) or "nothing"))
+        raise errors[0]
+    pod, ingress = outcomes["pod"][0], outcomes["ingress"][0]
+    urls[pod.metadata.uid] = format_url(ingress.spec.rules[0].host, kwargs["token"])
+    progress("Created notebook %s" %notebook_name)
+    logger.info("Created notebook %s (%s)" %(notebook_name, format_timings(outcomes)))
 
 def get_notebooks(username=None):
     notebooks = []
-    api = client.CoreV1Api()
-    label_selector = "k8s-app in (jupyterlab, privatejupyter),owner=%s" %username if username else "k8s-app in (jupyterlab, privatejupyter)"
-    pods = api.list_namespaced_pod(namespace, label_selector=label_selector).items 
-    for pod in pods:
-        notebooks.append({
-            "notebook_id": pod.metadata.name, 
-            "notebook_name": pod.metadata.labels.get("notebook-name") or pod.metadata.labels.get("display-name"),
-            "namespace": namespace, 
-            "username": pod.metadata.labels.get("owner"),
-            "status": get_notebook_status(pod),
-            "pod_status": pod.status.phase,
-            "conditions": get_conditions(pod),
-            "url": get_url(pod),
-            "creation_date": pod.metadata.creation_timestamp.isoformat(),
-            "expiration_date": get_expiration_date(pod).isoformat(),
-            "requests": get_requests(pod),
-            "limits": get_limits(pod),
-            "gpu": get_basic_gpu_info(pod),
-            "hours_remaining": get_hours_remaining(pod)}) 
+    pod_list = sorted(pods.list("owner", username) if username else pods.list(), key=lambda pod : pod.metadata.name)
+    futures = [executor.submit(tracing.in_context(get_notebook_summary), pod) for pod in pod_list]
+    done, _ = wait(futures, timeout=enrichment_deadline)
+    for pod, future in zip(pod_list, futures):
+        if future in done and not future.exception():
+            notebooks.append(future.result())
+            continue
+        if future in done:
+            logger.error("Error getting notebook %s: %s" %(pod.metadata.name, str(future.exception())))
+        else:
+            future.cancel()
+            logger.warning("Notebook %s was not ready within %s seconds" %(pod.metadata.name, enrichment_deadline))
+        notebooks.append(get_notebook_summary(pod, enrich=False))
     return notebooks
 
 def get_notebook(notebook_name):
-    api = client.CoreV1Api()
-    pod = api.read_namespaced_pod(name=notebook_name, namespace=namespace)
+    api = core_v1_api()
+    pod = get_pod(notebook_name)
     log = api.read_namespaced_pod_log(name=notebook_name, namespace=namespace)
     notebook = {
         "notebook_id": pod.metadata.name,
@@ -108,29 +150,40 @@ def get_notebook(notebook_name):
     }
     return notebook
 
+def get_notebook_summary(pod, enrich=True):
+    return {
+        "notebook_id": pod.metadata.name,
+        "notebook_name": pod.metadata.labels.get("notebook-name") or pod.metadata.labels.get("display-name"),
+        "namespace": namespace,
+        "username": pod.metadata.labels.get("owner"),
+        "status": get_notebook_status(pod) if enrich else "Unknown",
+        "pod_status": pod.status.phase,
+        "conditions": get_conditions(pod),
+        "url": get_url(pod) if enrich else None,
+        "creation_date": pod.metadata.creation_timestamp.isoformat(),
+        "expiration_date": get_expiration_date(pod).isoformat(),
+        "requests": get_requests(pod),
+        "limits": get_limits(pod),
+        "gpu": get_basic_gpu_info(pod) if enrich else None,
+        "hours_remaining": get_hours_remaining(pod)}
+
 def list_notebooks():
-    notebooks = []
-    api = client.CoreV1Api()
-    pods = api.list_namespaced_pod(namespace=namespace, label_selector="k8s-app in (jupyterlab, privatejupyter)").items
-    for pod in pods:
-        notebooks.append(pod.metadata.name)
-    return notebooks
+    return sorted(pod.metadata.name for pod in pods.list())
 
 def remove_notebook(notebook_name):
     notebook_id = notebook_name.lower()
-    core_v1_api = client.CoreV1Api()
-    networking_v1_api = client.NetworkingV1Api()
-    core_v1_api.delete_namespaced_pod(notebook_id, namespace)
-    core_v1_api.delete_namespaced_service(notebook_id, namespace)
-    networking_v1_api.delete_namespaced_ingress(notebook_id, namespace)
-    core_v1_api.delete_namespaced_secret(notebook_id, namespace)
-    logger.info("Removed notebook %s from namespace %s" %(notebook_id, namespace))
+    outcomes = run_steps({kind: lambda delete=delete : delete(notebook_id) for kind, delete in deleters.items()})
+    errors = [outcome[1] for outcome in outcomes.values() if outcome[1] and getattr(outcome[1], "status", None) != 404]
+    if errors:
+        logger.error("Unable to remove notebook %s from namespace %s (%s)" %(notebook_id, namespace, format_timings(outcomes)))
+        raise errors[0]
+    logger.info("Removed notebook %s from namespace %s (%s)" %(notebook_id, namespace, format_timings(outcomes)))
+    # Whether the pod was there to delete, rather than already gone
+    return outcomes["pod"][1] is None
 
 def notebook_name_available(notebook_name):
     notebook_id = notebook_name.lower()
-    core_v1_api = client.CoreV1Api()
-    pods = core_v1_api.list_namespaced_pod(namespace, label_selector="notebook-id={0}".format(notebook_id))
-    return len(pods.items) == 0
+    return len(pods.list("notebook-id", notebook_id)) == 0
 
 def generate_notebook_name(username):
     for i in range(1, 20):
@@ -147,46 +200,36 @@ def supported_images():
         "hub.opensciencegrid.org/usatlas/ml-platform:lava"]
 
 def get_gpus():
-    gpus = dict()
-    api = client.CoreV1Api()
-    nodes = api.list_node(label_selector="gpu=true")
-    for node in nodes.items:
-        product = node.metadata.labels["nvidia.com/gpu.product"]
-        memory = int(node.metadata.labels["nvidia.com/gpu.memory"])
-        count = int(node.metadata.labels["nvidia.com/gpu.count"])
-        if memory not in gpus:
-            gpus[memory] = {"product": product, "memory": memory, "count": count, "available": count} 
-        else:
-            gpus[memory]["count"] += count
-            gpus[memory]["available"] += count 
-        pods = api.list_pod_for_all_namespaces(field_selector="spec.nodeName=%s" %node.metadata.name).items
-        for pod in pods:
-            requests = pod.spec.containers[0].resources.requests
-            if requests:
-                gpus[memory]["available"] -= int(requests.get("nvidia.com/gpu", 0))
-        gpus[memory]["available"] = max(gpus[memory]["available"], 0)
-    return sorted(gpus.values(), key=lambda gpu:gpu["memory"])
+    return get_gpu_index().list()
 
 def get_gpu(memory):
-    gpu = dict()
-    api = client.CoreV1Api()
-    nodes=api.list_node(label_selector="gpu=true,nvidia.com/gpu.memory=%s" %memory)
-    for node in nodes.items:
-        if gpu:
-            gpu["count"] += int(node.metadata.labels["nvidia.com/gpu.count"])
-            gpu["available"] = gpu["count"]
-        else:
-            gpu["product"] = node.metadata.labels["nvidia.com/gpu.product"]
-            gpu["memory"] = int(node.metadata.labels["nvidia.com/gpu.memory"])
-            gpu["count"] = int(node.metadata.labels["nvidia.com/gpu.count"])
-            gpu["available"] = gpu["count"]
-        pods = api.list_pod_for_all_namespaces(field_selector="spec.nodeName=%s" %node.metadata.name).items
-        for pod in pods:
-            requests = pod.spec.containers[0].resources.requests
-            if requests:
-                gpu["available"] -= int(requests.get("nvidia.com/gpu", 0))
-                gpu["available"] = max(gpu["available"], 0)
-    return gpu
+    return get_gpu_index().get(memory)
+
+def get_gpu_nodes():
+    return get_gpu_index().list_nodes()
+
+# Until the node and pod informers have synced, the counts are built from a scan of the API instead,
+# which raises if the API cannot be reached rather than reporting no GPUs
+def get_gpu_index():
+    if nodes.synced.is_set() and scheduled_pods.synced.is_set():
+        return gpu_index
+    index = GPUIndex()
+    for node in nodes.list():
+        index.on_node("ADDED", node)
+    for pod in scheduled_pods.list():
+        index.on_pod("ADDED", pod)
+    return index
+
+def get_node_gpu(node_name):
+    gpu = gpu_index.node(node_name) if nodes.synced.is_set() else None
+    return gpu or node_labels.get(node_name, read_node_gpu)
+
+def read_node_gpu(node_name):
+    gpu_labels = get_gpu_labels(core_v1_api().read_node(node_name))
+    if not gpu_labels:
+        return None
+    product, memory, count = gpu_labels
+    return {"product": product, "memory": memory, "count": count}
 
 def validate(notebook_name, **kwargs):
     if " " in notebook_name:
@@ -214,11 +257,51 @@ def validate(notebook_name, **kwargs):
             %(gpu["product"], kwargs["gpu_request"], "instance" if kwargs["gpu_request"] == 1 else "instances"))
 
 # Helper functions
+deleters = {
+    "pod": lambda notebook_id : core_v1_api().delete_namespaced_pod(notebook_id, namespace),
+    "service": lambda notebook_id : core_v1_api().delete_namespaced_service(notebook_id, namespace),
+    "ingress": lambda notebook_id : networking_v1_api().delete_namespaced_ingress(notebook_id, namespace),
+    "secret": lambda notebook_id : core_v1_api().delete_namespaced_secret(notebook_id, namespace)}
+
+# An object that is already gone counts as deleted
+def delete_object(kind, notebook_id):
+    try:
+        deleters[kind](notebook_id)
+    except client.ApiException as err:
+        if err.status != 404:
+            raise
+
+# Deletes the objects of a notebook that failed to create, retrying failed deletes, and returns the kinds still left
+def roll_back(notebook_id, kinds):
+    remaining = list(kinds)
+    for attempt in range(1, rollback_attempts + 1):
+        outcomes = run_steps({kind: lambda kind=kind : delete_object(kind, notebook_id) for kind in remaining})
+        for kind, outcome in outcomes.items():
+            if outcome[1]:
+                logger.error("Unable to roll back %s %s (attempt %d of %d): %s" %(kind, notebook_id, attempt, rollback_attempts, str(outcome[1])))
+        remaining = [kind for kind, outcome in outcomes.items() if outcome[1]]
+        if not remaining or attempt == rollback_attempts:
+            break
+        time.sleep(rollback_retry_delay * attempt)
+    return remaining
+
+# Runs the steps concurrently and returns the result, error and duration in seconds of each step
+def run_steps(steps):
+    def run(step):
+        start = time.perf_counter()
+        try:
+            return step(), None, time.perf_counter() - start
+        except Exception as err:
+            return None, err, time.perf_counter() - start
+    futures = {name: orchestration_executor.submit(tracing.in_context(run), step) for name, step in steps.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+def format_timings(outcomes):
+    return ", ".join("%s %s in %d ms" %(name, "failed" if outcome[1] else "done", outcome[2] * 1000) for name, outcome in outcomes.items())
+
 def create_pod(notebook_name, **kwargs):
-    api = client.CoreV1Api()
-    templates = Environment(loader=FileSystemLoader("portal/templates/jupyterlab"))
-    template = templates.get_template("pod.yaml")
-    pod = yaml.safe_load(template.render(
+    api = core_v1_api()
+    pod = manifests.build("pod",
         notebook_id=notebook_name.lower(), 
         notebook_name=notebook_name,
         namespace=namespace, 
@@ -233,48 +316,40 @@ def create_pod(notebook_name, **kwargs):
         gpu_limit=kwargs["gpu_limit"],
         gpu_memory=kwargs["gpu_memory"],
         image=kwargs["image"], 
-        hours=kwargs["duration"]))                           
-    api.create_namespaced_pod(namespace=namespace, body=pod)
+        hours=kwargs["duration"])
+    return api.create_namespaced_pod(namespace=namespace, body=pod)
 
 def create_service(notebook_name, **kwargs):
-    api = client.CoreV1Api()
-    templates = Environment(loader=FileSystemLoader("portal/templates/jupyterlab"))
-    template = templates.get_template("service.yaml")
-    service = yaml.safe_load(template.render(
+    api = core_v1_api()
+    service = manifests.build("service",
         notebook_id=notebook_name.lower(),
         namespace=namespace, 
-        image=kwargs["image"]))
+        image=kwargs["image"])
     api.create_namespaced_service(namespace=namespace, body=service)
 
 def create_ingress(notebook_name, **kwargs):
-    api = client.NetworkingV1Api()
-    templates = Environment(loader=FileSystemLoader("portal/templates/jupyterlab"))
-    template = templates.get_template("ingress.yaml")
-    ingress = yaml.safe_load(template.render(
+    api = networking_v1_api()
+    ingress = manifests.build("ingress",
         notebook_id=notebook_name.lower(),
         namespace=namespace, 
         domain_name=domain_name, 
         username=kwargs["username"], 
-        image=kwargs["image"]))
-    api.create_namespaced_ingress(namespace=namespace, body=ingress)
+        image=kwargs["image"])
+    return api.create_namespaced_ingress(namespace=namespace, body=ingress)
 
 def create_secret(notebook_name, **kwargs):
-    api = client.CoreV1Api()
-    templates = Environment(loader=FileSystemLoader("portal/templates/jupyterlab"))
-    template = templates.get_template("secret.yaml")
-    sec = yaml.safe_load(template.render(
+    api = core_v1_api()
+    sec = manifests.build("secret",
         notebook_id=notebook_name.lower(), 
         namespace=namespace, 
         username=kwargs["username"], 
-        token=kwargs["token"]))
+        token=kwargs["token"])
     api.create_namespaced_secret(namespace=namespace, body=sec)
 
 def create_pvc_if_needed(username):
-    api = client.CoreV1Api()
-    templates = Environment(loader=FileSystemLoader("portal/templates/jupyterlab"))
+    api = core_v1_api()
     if len(api.list_namespaced_persistent_volume_claim(namespace, label_selector=f"owner={username}").items) == 0:
-        template = templates.get_template("pvc.yaml")
-        pvc = yaml.safe_load(template.render(username=username, namespace=namespace))
+        pvc = manifests.build("pvc", username=username, namespace=namespace)
         api.create_namespaced_persistent_volume_claim(namespace=namespace, body=pvc)
         logger.info("Created persistent volume claim for user %s" %username)
 
@@ -316,11 +391,9 @@ def get_basic_gpu_info(pod):
     if pod.spec.node_name:
         requests = pod.spec.containers[0].resources.requests
         if int(requests.get("nvidia.com/gpu", 0)) > 0:
-            api = client.CoreV1Api()
-            node = api.read_node(pod.spec.node_name)
-            product = node.metadata.labels["nvidia.com/gpu.product"]
-            memory = str(float(node.metadata.labels["nvidia.com/gpu.memory"])/1000) + " GB"
-            return {"product": product, "memory":  memory}
+            gpu = get_node_gpu(pod.spec.node_name)
+            if gpu:
+                return {"product": gpu["product"], "memory": str(float(gpu["memory"])/1000) + " GB"}
     return None
 
 def get_notebook_status(pod):
@@ -328,9 +401,7 @@ def get_notebook_status(pod):
         return "Removing notebook..."
     ready = next(filter(lambda c : c.type == "Ready" and c.status == "True", pod.status.conditions), None)
     if ready:
-        api = client.CoreV1Api()
-        log = api.read_namespaced_pod_log(pod.metadata.name, namespace=namespace)
-        if re.search("Jupyter Notebook.*is running at", log) or re.search("Jupyter Server.*is running at", log):
+        if readiness.is_ready(pod):
             return "Ready"
         return "Starting notebook..."   
     return "Pending"
@@ -344,7 +415,7 @@ def get_conditions(pod):
     
 def get_events(pod):
     notebook_events = []
-    api = client.CoreV1Api()
+    api = core_v1_api()
     events = api.list_namespaced_event(namespace=namespace, field_selector="involvedObject.uid=%s" %pod.metadata.uid).items
     for event in events:
         notebook_events.append({"message": event.message, "timestamp": event.last_timestamp.isoformat()})
@@ -353,13 +424,23 @@ def get_events(pod):
 def get_url(pod):
     if pod.metadata.deletion_timestamp:
         return None
+    url = urls.get(pod.metadata.uid)
+    if url:
+        url_stats["hits"] += 1
+        return url
+    url_stats["misses"] += 1
     notebook_id = pod.metadata.name
-    api = client.NetworkingV1Api()
-    ingress = api.read_namespaced_ingress(notebook_id, namespace)
-    api = client.CoreV1Api()
-    token = api.read_namespaced_secret(notebook_id, namespace).data["token"]
-    return "https://" + ingress.spec.rules[0].host + "?" + urllib.parse.urlencode({"token": token})
+    ingress = networking_v1_api().read_namespaced_ingress(notebook_id, namespace)
+    secret = core_v1_api().read_namespaced_secret(notebook_id, namespace)
+    url = urls[pod.metadata.uid] = format_url(ingress.spec.rules[0].host, secret.data["token"])
+    return url
+
+def format_url(host, token):
+    return "https://" + host + "?" + urllib.parse.urlencode({"token": token})
 
 def get_pod(pod_name):
-    api = client.CoreV1Api()
+    pod = pods.get(pod_name)
+    if pod:
+        return pod
+    api = core_v1_api()
     return api.read_namespaced_pod(name=pod_name, namespace=namespace)
\ No newline at end of file
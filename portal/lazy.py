@@ -0,0 +1,27 @@
+# This module defers importing heavy packages, like Matplotlib and the Kubernetes client, until they are first used
+# A worker that never renders a chart or talks to Kubernetes then never pays for importing them
+
+import importlib
+import threading
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # import_module holds the import lock, so concurrent first uses import the package once
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+    def __repr__(self):
+        return "<lazy module %s%s>" %(self._name, "" if self._module else " (not loaded)")
+
+def load(name):
+    return LazyModule(name)
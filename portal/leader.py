@@ -0,0 +1,35 @@
+# This module elects one process to run background duties, like removing expired notebooks
+# The leader is the process that holds an exclusive lock on a file, which is released when the process exits
+
+import os
+import fcntl
+import threading
+
+class LeaderLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.file:
+                return True
+            f = open(self.path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            f.truncate(0)
+            f.write(str(os.getpid()))
+            f.flush()
+            self.file = f
+            return True
+
+    def release(self):
+        with self.lock:
+            if self.file:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+                self.file.close()
+                self.file = None
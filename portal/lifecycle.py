@@ -0,0 +1,80 @@
+# This module runs the application lifecycle: setup shared by all workers, the threads each worker runs, and shutdown
+# Under uWSGI the kubeconfig is loaded once in the master before it forks, and worker threads start right after the fork
+# Anywhere else, or if that hook did not run, a process starts its threads on its first request
+# Background duties, like removing expired notebooks and syncing user profiles, run only in the process holding the leader lock
+
+import os
+import atexit
+import threading
+import portal
+from portal import app, logger, jupyterlab, expiration, profile_store, tracing
+from portal.leader import LeaderLock
+
+try:
+    import uwsgi
+    import uwsgidecorators
+except ImportError:
+    uwsgi = None
+
+leader = LeaderLock(app.config.get("LEADER_LOCK_PATH", "portal.lock"))
+# A process that is not the leader tries again this often, and takes over if the leader has exited
+leader_retry_interval = app.config.get("LEADER_RETRY_INTERVAL", 60)
+state = {"setup": False, "worker": None, "leader": False}
+lock = threading.RLock()
+stopped = threading.Event()
+
+# Work that is the same in every worker and safe to do before forking: no threads and no open connections
+def setup():
+    with lock:
+        if not state["setup"]:
+            jupyterlab.load_kube_config()
+            state["setup"] = True
+
+# Starting a worker does not wait on Kubernetes, so pages that do not use it are served during an outage
+def start_worker():
+    with lock:
+        if state["worker"] == os.getpid():
+            return
+        setup()
+        stopped.clear()
+        state["leader"] = False
+        jupyterlab.start_informers()
+        threading.Thread(target=run_background_duties, daemon=True).start()
+        state["worker"] = os.getpid()
+    logger.info("Started worker %d" %os.getpid())
+
+def run_background_duties():
+    while not leader.acquire():
+        if stopped.wait(leader_retry_interval):
+            return
+    state["leader"] = True
+    logger.info("Process %d is the leader and runs the background duties" %os.getpid())
+    expiration.start_expiration_scheduler()
+    profile_store.start_profile_sync()
+
+def shutdown():
+    if stopped.is_set():
+        return
+    stopped.set()
+    jupyterlab.stop_informers()
+    if state["leader"]:
+        expiration.scheduler.stop()
+        profile_store.stop_profile_sync()
+        leader.release()
+    # Deploys that were already accepted are finished before the process exits
+    jupyterlab.deploys.shutdown(wait=True)
+    tracing.exporter.stop()
+    logger.info("Stopped worker %d" %os.getpid())
+    portal.log_listener.stop()
+
+@app.before_request
+def start_worker_on_first_request():
+    if state["worker"] != os.getpid():
+        start_worker()
+
+if uwsgi:
+    setup()
+    uwsgidecorators.postfork(start_worker)
+    uwsgi.atexit = shutdown
+else:
+    atexit.register(shutdown)
@@ -0,0 +1,105 @@
+# This module sets up logging so that writing a log line never waits on the terminal or the disk
+# Log records go onto a bounded queue, and a background thread writes them to the console and to a rotating log file
+# With LOG_FORMAT = "json", each line is a JSON object that includes the request id, route and latency of the request that logged it
+# Every worker appends to the same log file, so it is rotated outside the portal, by logrotate; each worker reopens the file once it has moved.
+# Rotating it from the portal (LOG_MAX_BYTES or LOG_ROTATE_WHEN) is for a single process only, and is turned off under uWSGI,
+# where each worker would rotate the shared file on its own and lose lines
+
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler, WatchedFileHandler
+from flask import g, request, has_request_context
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+text_format = "%(asctime)s;%(module)s;%(funcName)s;%(levelname)s;%(message)s"
+stats = {"records_dropped": 0}
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "module": record.module,
+            "function": record.funcName,
+            "message": record.getMessage()}
+        for key in ("request_id", "route", "latency_ms"):
+            if getattr(record, key, None) is not None:
+                line[key] = getattr(record, key)
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line)
+
+# Runs in the thread that logs, which is the only place that can see the request
+class RequestFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context() and "request_id" in g:
+            record.request_id = g.request_id
+            record.route = request.url_rule.rule if request.url_rule else request.path
+            record.latency_ms = round((time.perf_counter() - g.request_started) * 1000, 1)
+        return True
+
+# Drops a record rather than blocking when the writer thread falls behind
+class DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats["records_dropped"] += 1
+
+# A forked worker does not inherit the writer thread, so the listener is started again in the child
+class Listener(QueueListener):
+    def stop(self):
+        if self._thread:
+            super().stop()
+
+    def restart(self):
+        self._thread = None
+        self.start()
+
+def configure_logging(app, logger):
+    if app.config.get("LOG_FORMAT", "text") == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(text_format)
+    filename = app.config.get("LOG_FILE", "portal.log")
+    rotate = (app.config.get("LOG_ROTATE_WHEN") or app.config.get("LOG_MAX_BYTES")) and not uwsgi
+    if rotate and app.config.get("LOG_ROTATE_WHEN"):
+        fh = TimedRotatingFileHandler(filename, when=app.config["LOG_ROTATE_WHEN"], backupCount=app.config.get("LOG_BACKUP_COUNT", 5))
+    elif rotate:
+        fh = RotatingFileHandler(filename, maxBytes=app.config["LOG_MAX_BYTES"], backupCount=app.config.get("LOG_BACKUP_COUNT", 5))
+    else:
+        fh = WatchedFileHandler(filename)
+    ch = logging.StreamHandler()
+    for handler in (ch, fh):
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(formatter)
+    qh = DroppingQueueHandler(queue.Queue(app.config.get("LOG_QUEUE_SIZE", 10000)))
+    qh.addFilter(RequestFilter())
+    logger.addHandler(qh)
+    listener = Listener(qh.queue, ch, fh, respect_handler_level=True)
+    listener.start()
+    os.register_at_fork(after_in_child=listener.restart)
+    if uwsgi and (app.config.get("LOG_ROTATE_WHEN") or app.config.get("LOG_MAX_BYTES")):
+        logger.warning("LOG_MAX_BYTES and LOG_ROTATE_WHEN are ignored under uWSGI; rotate %s with logrotate instead" %filename)
+
+    @app.before_request
+    def start_request_log():
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def add_request_id(response):
+        if "request_id" in g:
+            response.headers["X-Request-ID"] = g.request_id
+        return response
+
+    return listener
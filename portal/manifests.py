@@ -0,0 +1,18 @@
+# This module builds the Kubernetes manifests of a notebook from the templates in templates/jupyterlab
+# The templates are compiled once, when the module is imported, and parsed with the C YAML loader when it is available
+
+import os
+import yaml
+from jinja2 import Environment, FileSystemLoader
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "jupyterlab")
+environment = Environment(loader=FileSystemLoader(template_dir))
+templates = {kind: environment.get_template(kind + ".yaml") for kind in ("pod", "service", "ingress", "secret", "pvc")}
+
+def build(kind, **kwargs):
+    return yaml.load(templates[kind].render(**kwargs), Loader=Loader)
@@ -0,0 +1,143 @@
+# This module records latency and error metrics for requests and backend calls
+# The metrics are rendered in the Prometheus text format by the /metrics endpoint
+# Each process keeps its own metrics, so with several workers each scrape sees the worker that answered it
+
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from flask import g, request
+from portal import app, logs, tracing
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join('%s="%s"' %(name, escape(value)) for name, value in labels) + "}" if labels else ""
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.series = dict()
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" %(self.name, self.documentation), "# TYPE %s counter" %self.name]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.append("%s%s %s" %(self.name, format_labels(key), value))
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.series = dict()
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" %(self.name, self.documentation), "# TYPE %s histogram" %self.name]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append("%s_bucket%s %d" %(self.name, format_labels(key + (("le", bound),)), count))
+                lines.append("%s_bucket%s %d" %(self.name, format_labels(key + (("le", "+Inf"),)), series["count"]))
+                lines.append("%s_sum%s %s" %(self.name, format_labels(key), series["sum"]))
+                lines.append("%s_count%s %d" %(self.name, format_labels(key), series["count"]))
+        return lines
+
+metrics = []
+stats = []
+
+request_seconds = Histogram("portal_request_duration_seconds", "Time spent handling a request")
+request_errors = Counter("portal_request_errors_total", "Requests that raised an exception or returned a 5xx status")
+connect_call_seconds = Histogram("portal_connect_call_duration_seconds", "Time spent in calls to the Connect API")
+connect_call_errors = Counter("portal_connect_call_errors_total", "Calls to the Connect API that failed or returned a 5xx status")
+kubernetes_call_seconds = Histogram("portal_kubernetes_call_duration_seconds", "Time spent in calls to the Kubernetes API")
+kubernetes_call_errors = Counter("portal_kubernetes_call_errors_total", "Calls to the Kubernetes API that failed")
+
+# Exposes a dictionary of numbers, like the stats of a cache, as gauges named portal_<prefix>_<key>
+def register_stats(prefix, values, documentation):
+    stats.append((prefix, values, documentation))
+
+register_stats("tracing", tracing.exporter.stats, "Traces sent to the trace file or collector")
+register_stats("logging", logs.stats, "Log records dropped because the log writer fell behind")
+
+@contextmanager
+def timer(histogram, errors, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+# Wraps a Kubernetes API object so that each of its calls is timed, labeled with the name of the method
+class Instrumented:
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            with tracing.span("Kubernetes %s" %name, kind="client", **{"k8s.operation": name}):
+                with timer(kubernetes_call_seconds, kubernetes_call_errors, operation=name):
+                    return attr(*args, **kwargs)
+        return call
+
+def instrument(api):
+    return Instrumented(api)
+
+def render():
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    for prefix, values, documentation in stats:
+        for key, value in sorted(values.items()):
+            name = "portal_%s_%s" %(prefix, key)
+            lines += ["# HELP %s %s" %(name, documentation), "# TYPE %s gauge" %name, "%s %s" %(name, value)]
+    return "\n".join(lines) + "\n"
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if "request_start" in g:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.observe(time.perf_counter() - g.request_start, endpoint=endpoint, method=request.method, status=response.status_code)
+        if response.status_code >= 500:
+            request_errors.inc(endpoint=endpoint, method=request.method)
+    return response
+
+@app.teardown_request
+def record_request_error(err):
+    if err:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        request_errors.inc(endpoint=endpoint, method=request.method)
@@ -0,0 +1,63 @@
+# This module pushes notebook status changes to the browsers of their owners as Server-Sent Events
+# Pod watch events wake the streams of the pod's owner, which then send the notebooks whose summary changed
+# Streams are served only by the asyncio app in portal.asgi, and only when NOTEBOOK_EVENTS_ASYNC says it is in front;
+# a stream would hold a WSGI worker for as long as the page is open, so without it the page polls instead
+
+import json
+import threading
+from portal import app, jupyterlab, metrics
+
+heartbeat = app.config.get("NOTEBOOK_EVENTS_HEARTBEAT", 60)
+readiness_interval = app.config.get("NOTEBOOK_EVENTS_READINESS_INTERVAL", 2)
+max_age = app.config.get("NOTEBOOK_EVENTS_MAX_AGE", 600)
+max_streams = app.config.get("NOTEBOOK_EVENTS_MAX_STREAMS", 1000)
+enabled = app.config.get("NOTEBOOK_EVENTS_ASYNC", False)
+
+subscribers = dict()
+stats = {"streams": 0, "streams_refused": 0}
+lock = threading.Lock()
+
+# A subscription is anything with a put method, and receives the type of each pod event
+# Returns False when the process already has max_streams open, and the page should poll instead
+def subscribe(username, subscription):
+    with lock:
+        if stats["streams"] >= max_streams:
+            stats["streams_refused"] += 1
+            return False
+        stats["streams"] += 1
+        subscribers.setdefault(username, set()).add(subscription)
+    return True
+
+def unsubscribe(username, subscription):
+    with lock:
+        stats["streams"] -= 1
+        subscribers[username].discard(subscription)
+        if not subscribers[username]:
+            del subscribers[username]
+
+def publish(event_type, pod):
+    username = (pod.metadata.labels or {}).get("owner")
+    with lock:
+        for subscription in subscribers.get(username, ()):
+            subscription.put(event_type)
+
+def format_event(event, data):
+    return "event: %s\ndata: %s\n\n" %(event, json.dumps(data))
+
+def get_notebooks(username):
+    return {notebook["notebook_id"]: notebook for notebook in jupyterlab.get_notebooks(username)}
+
+# Returns the events that bring a browser that was sent one set of notebooks up to date with another
+def get_changes(sent, notebooks):
+    events = [format_event("notebook", notebook) for notebook_id, notebook in notebooks.items() if sent.get(notebook_id) != notebook]
+    events += [format_event("removed", {"notebook_id": notebook_id}) for notebook_id in set(sent) - set(notebooks)]
+    return events
+
+# Readiness shows up in the pod log rather than in a pod event, so starting notebooks are checked more often
+# A notebook whose status is Unknown is not, since checking it again soon rarely changes it
+def get_timeout(notebooks):
+    starting = any(notebook["status"] == "Starting notebook..." for notebook in notebooks.values())
+    return readiness_interval if starting else heartbeat
+
+jupyterlab.pods.add_handler(publish)
+metrics.register_stats("notebook_events", stats, "Open notebook event streams, and streams refused at the limit")
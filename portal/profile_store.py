@@ -0,0 +1,145 @@
+# This module keeps a local copy of the Connect user profiles in SQLite
+# Profiles are read from the store and fetched from Connect only when missing
+# A background thread adds new users and refreshes the oldest profiles a batch at a time
+
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from portal import app, logger, connect
+
+path = app.config.get("PROFILE_STORE_PATH", "profiles.db")
+sync_interval = app.config.get("PROFILE_SYNC_INTERVAL", 300)
+sync_batch_size = app.config.get("PROFILE_SYNC_BATCH_SIZE", 500)
+columns = ("username", "name", "email", "phone", "join_date", "institution", "role")
+stopped = threading.Event()
+
+@contextmanager
+def connection():
+    conn = sqlite3.connect(path, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("format_date", 2, format_date, deterministic=True)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+# Join dates are stored in ISO format, and searched in the format the table shows them in
+def format_date(value, date_format):
+    return datetime.fromisoformat(value).strftime(date_format) if date_format else value
+
+def create_tables():
+    with connection() as conn:
+        conn.execute("pragma journal_mode=wal")
+        conn.execute("""create table if not exists profiles (
+            username text primary key, name text, email text, phone text,
+            join_date text, institution text, role text, synced_at real)""")
+        conn.execute("create table if not exists sync (id integer primary key check (id = 0), synced_at real)")
+        for column in columns[1:]:
+            conn.execute("create index if not exists profiles_%s on profiles (%s)" %(column, column))
+
+def save_profiles(profiles):
+    now = time.time()
+    rows = [(p["username"], p["name"], p["email"], p["phone"], p["join_date"].isoformat(), p["institution"], p["role"], now) for p in profiles]
+    with connection() as conn:
+        conn.executemany("insert or replace into profiles values (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+def fetch_profiles(usernames):
+    profiles = connect.get_user_profiles(usernames, date_format=None)
+    save_profiles(profiles)
+    return len(profiles)
+
+def get_profiles(usernames, date_format="%B %m %Y"):
+    usernames = list(usernames)
+    fetch_missing_profiles(usernames)
+    with connection() as conn:
+        rows = conn.execute(
+            "select * from profiles where username in (select value from json_each(?))",
+            (json.dumps(usernames),)).fetchall()
+    return [to_profile(row, date_format) for row in rows]
+
+def query_profiles(usernames, date_format="%B %m %Y", start=0, length=-1, search="", order_by=None, descending=False):
+    usernames = list(usernames)
+    fetch_missing_profiles(usernames)
+    where = "username in (select value from json_each(?))"
+    args = [json.dumps(usernames)]
+    with connection() as conn:
+        total = conn.execute("select count(*) from profiles where " + where, args).fetchone()[0]
+        if search:
+            pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            searched = ["%s like ? escape '\\'" %column for column in columns if column != "join_date"]
+            searched.append("format_date(join_date, ?) like ? escape '\\'")
+            where += " and (" + " or ".join(searched) + ")"
+            args += [pattern] * (len(columns) - 1) + [date_format, pattern]
+        filtered = conn.execute("select count(*) from profiles where " + where, args).fetchone()[0]
+        order = "%s %s, username" %(order_by, "desc" if descending else "asc") if order_by in columns else "username"
+        rows = conn.execute(
+            "select * from profiles where " + where + " order by " + order + " limit ? offset ?",
+            args + [length if length > 0 else -1, start]).fetchall()
+    return total, filtered, [to_profile(row, date_format) for row in rows]
+
+def fetch_missing_profiles(usernames):
+    with connection() as conn:
+        known = set(row["username"] for row in conn.execute(
+            "select username from profiles where username in (select value from json_each(?))",
+            (json.dumps(usernames),)))
+    missing = [username for username in usernames if username not in known]
+    if missing:
+        fetch_profiles(missing)
+
+def to_profile(row, date_format):
+    join_date = datetime.fromisoformat(row["join_date"])
+    return {
+        "username": row["username"],
+        "email": row["email"],
+        "phone": row["phone"],
+        "join_date": join_date.strftime(date_format) if date_format else join_date,
+        "institution": row["institution"],
+        "name": row["name"],
+        "role": row["role"]}
+
+def delete_profile(username):
+    with connection() as conn:
+        conn.execute("delete from profiles where username = ?", (username,))
+
+def get_last_synced():
+    with connection() as conn:
+        row = conn.execute("select synced_at from sync").fetchone()
+    if row:
+        return datetime.fromtimestamp(row["synced_at"], timezone.utc).isoformat()
+    return None
+
+def sync():
+    usernames = connect.get_group_members("root")
+    members = set(usernames)
+    with connection() as conn:
+        known = {row["username"]: row["synced_at"] for row in conn.execute("select username, synced_at from profiles")}
+        removed = [username for username in known if username not in members]
+        conn.executemany("delete from profiles where username = ?", [(username,) for username in removed])
+    new = [username for username in usernames if username not in known]
+    stale = sorted((username for username in usernames if username in known), key=lambda username : known[username])
+    count = fetch_profiles(new + stale[:max(sync_batch_size - len(new), 0)])
+    with connection() as conn:
+        conn.execute("insert or replace into sync values (0, ?)", (time.time(),))
+    logger.info("Synced %d user profiles (%d new, %d removed)" %(count, len(new), len(removed)))
+
+def start_profile_sync():
+    def run():
+        while not stopped.is_set():
+            try:
+                sync()
+            except Exception as err:
+                logger.error("Error syncing user profiles: %s" %str(err))
+            stopped.wait(sync_interval)
+    stopped.clear()
+    threading.Thread(target=run, daemon=True).start()
+    logger.info("Started user profile sync")
+
+def stop_profile_sync():
+    stopped.set()
+
+create_tables()
+connect.invalidation_handlers.append(delete_profile)
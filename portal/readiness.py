@@ -0,0 +1,70 @@
+# This module tracks whether the Jupyter server inside a notebook pod has started
+# A pod is checked by reading the head of its log once, then only the lines written since the last check
+# When the head is too long to hold the startup line, the tail is read, and then the whole log once, since the line may be in between
+# Once the server is seen running, the pod stays ready for the lifetime of its uid
+
+import re
+import time
+import threading
+from portal import metrics, lazy
+
+client = lazy.load("kubernetes.client")
+
+pattern = re.compile("Jupyter (Notebook|Server).*is running at")
+
+class ReadinessTracker:
+    def __init__(self, namespace, head_bytes=65536, tail_lines=200):
+        self.namespace = namespace
+        self.head_bytes = head_bytes
+        self.tail_lines = tail_lines
+        self.ready = set()
+        self.checked = dict()
+        self.bytes_read = dict()
+        self.lock = threading.Lock()
+        self.stats = {"log_reads": 0, "log_bytes_read": 0, "log_bytes_avoided": 0, "ready_hits": 0}
+
+    def is_ready(self, pod):
+        uid = pod.metadata.uid
+        with self.lock:
+            if uid in self.ready:
+                self.stats["ready_hits"] += 1
+                self.stats["log_bytes_avoided"] += self.bytes_read.get(uid, 0)
+                return True
+            last_check = self.checked.get(uid)
+        now = time.time()
+        if last_check is None:
+            kwargs = {"limit_bytes": self.head_bytes}
+        elif last_check == "tail":
+            kwargs = {"tail_lines": self.tail_lines}
+        elif last_check == "full":
+            kwargs = {}
+        else:
+            kwargs = {"since_seconds": int(now - last_check) + 2}
+        api = metrics.instrument(client.CoreV1Api())
+        log = api.read_namespaced_pod_log(pod.metadata.name, namespace=self.namespace, **kwargs)
+        size = len(log.encode())
+        ready = pattern.search(log) is not None
+        with self.lock:
+            self.stats["log_reads"] += 1
+            self.stats["log_bytes_read"] += size
+            if last_check not in (None, "tail", "full"):
+                self.stats["log_bytes_avoided"] += self.bytes_read.get(uid, 0)
+            self.bytes_read[uid] = self.bytes_read.get(uid, 0) + size
+            if ready:
+                self.ready.add(uid)
+                self.checked.pop(uid, None)
+            elif last_check is None and size >= self.head_bytes:
+                # The head of the log was too long to hold the startup line, so look at the tail next time
+                self.checked[uid] = "tail"
+            elif last_check == "tail":
+                # The startup line may be between the head and the tail, which only a full read finds
+                self.checked[uid] = "full"
+            else:
+                self.checked[uid] = now
+        return ready
+
+    def forget(self, uid):
+        with self.lock:
+            self.ready.discard(uid)
+            self.checked.pop(uid, None)
+            self.bytes_read.pop(uid, None)
@@ -0,0 +1,251 @@
+# This module records a tree of timed spans for each request, covering the calls it makes to the Connect and Kubernetes APIs
+# Finished traces can be appended to a file or sent to an OpenTelemetry collector, in the OTLP/JSON format
+# A request slower than SLOW_REQUEST_THRESHOLD seconds has its whole span tree written to the log
+
+import os
+import json
+import time
+import queue
+import functools
+import threading
+import contextvars
+import requests
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, request
+from portal import app, logger
+
+export_path = app.config.get("TRACE_EXPORT_PATH")
+export_endpoint = app.config.get("TRACE_EXPORT_ENDPOINT")
+service_name = app.config.get("TRACE_SERVICE_NAME", "af-portal")
+slow_request_threshold = app.config.get("SLOW_REQUEST_THRESHOLD", 1.0)
+# Streams and long polls are slow on purpose, so they are left out of the slow request log
+slow_request_exclude = app.config.get("SLOW_REQUEST_EXCLUDE", ("/jupyterlab/events", "/jupyterlab/deploy/<job_id>"))
+
+current_span = contextvars.ContextVar("current_span", default=None)
+kinds = {"internal": 1, "server": 2, "client": 3}
+
+class Span:
+    def __init__(self, name, kind="internal", trace_id=None, parent_id=None, root=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.root = root or self
+        self.attributes = attributes or {}
+        self.children = []
+        self.error = None
+        self.start_time = time.time_ns()
+        self.end_time = None
+        if root is None:
+            self.lock = threading.Lock()
+
+    def child(self, name, kind="internal", attributes=None):
+        span = Span(name, kind, self.trace_id, self.span_id, self.root, attributes)
+        with self.root.lock:
+            self.children.append(span)
+        return span
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, err):
+        self.error = "%s: %s" %(type(err).__name__, str(err))
+
+    def finish(self):
+        self.end_time = time.time_ns()
+
+    @property
+    def duration(self):
+        return ((self.end_time or time.time_ns()) - self.start_time) / 1e9
+
+    def traceparent(self):
+        return "00-%s-%s-01" %(self.trace_id, self.span_id)
+
+    def walk(self, depth=0):
+        yield depth, self
+        with self.root.lock:
+            children = list(self.children)
+        for child in children:
+            yield from child.walk(depth + 1)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": kinds[self.kind],
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time or time.time_ns()),
+            "attributes": [{"key": key, "value": to_otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}}
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+# Stands in for a span when nothing is being traced, so callers do not have to check
+class NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def traceparent(self):
+        return None
+
+null_span = NullSpan()
+
+def to_otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def to_otlp(roots):
+    spans = [span.to_otlp() for root in roots for _, span in root.walk()]
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+        "scopeSpans": [{"scope": {"name": "portal.tracing"}, "spans": spans}]}]}
+
+# Reads a W3C traceparent header, so that a request can join a trace started by a proxy or another service
+def parse_traceparent(header):
+    parts = (header or "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+# Times a block of code as a child of the current span; does nothing outside of a trace
+@contextmanager
+def span(name, kind="internal", **attributes):
+    parent = current_span.get()
+    if parent is None:
+        yield null_span
+        return
+    child = parent.child(name, kind, attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except Exception as err:
+        child.fail(err)
+        raise
+    finally:
+        current_span.reset(token)
+        child.finish()
+
+# Starts a new trace, or a new part of an existing trace when given the span it follows from
+@contextmanager
+def trace(name, kind="internal", follows=None, **attributes):
+    root = Span(name, kind, follows.trace_id if follows else None, follows.span_id if follows else None, attributes=attributes)
+    token = current_span.set(root)
+    try:
+        yield root
+    except Exception as err:
+        root.fail(err)
+        raise
+    finally:
+        current_span.reset(token)
+        root.finish()
+        exporter.export(root)
+
+# Wraps a function so that it runs in a copy of the caller's context, which lets work handed to a thread pool join the caller's trace
+def in_context(fn):
+    return functools.partial(contextvars.copy_context().run, fn)
+
+def format_tree(root):
+    calls = Counter(span.name for _, span in root.walk() if span.kind == "client")
+    repeated = ", ".join("%d x %s" %(count, name) for name, count in calls.most_common() if count > 1)
+    lines = ["Slow request %s took %.3fs (trace %s)%s" %(root.name, root.duration, root.trace_id, "; repeated calls: " + repeated if repeated else "")]
+    for depth, span in root.walk():
+        duration = "%.3fs" %span.duration if span.end_time else "unfinished"
+        offset = (span.start_time - root.start_time) / 1e9
+        lines.append("%s+%.3fs %s %s%s" %("  " * (depth + 1), offset, duration, span.name, " [%s]" %span.error if span.error else ""))
+    return "\n".join(lines)
+
+# Sends finished traces from a background thread, so that requests never wait on the file or the collector
+class Exporter:
+    def __init__(self, path=None, endpoint=None, max_pending=1000, batch_size=100):
+        self.path = path
+        self.endpoint = endpoint
+        self.queue = queue.Queue(max_pending)
+        self.batch_size = batch_size
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {"traces_exported": 0, "traces_dropped": 0, "export_errors": 0}
+
+    def export(self, root):
+        if not (self.path or self.endpoint):
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait(root)
+        except queue.Full:
+            self.stats["traces_dropped"] += 1
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            roots = [self.queue.get()]
+            while len(roots) < self.batch_size and not self.queue.empty():
+                roots.append(self.queue.get_nowait())
+            stopping = None in roots
+            roots = [root for root in roots if root is not None]
+            if roots:
+                self.send(roots)
+
+    def send(self, roots):
+        body = to_otlp(roots)
+        try:
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(body) + "\n")
+            if self.endpoint:
+                requests.post(self.endpoint, json=body, timeout=5).raise_for_status()
+            self.stats["traces_exported"] += len(roots)
+        except Exception as err:
+            self.stats["export_errors"] += 1
+            logger.error("Unable to export %d traces: %s" %(len(roots), str(err)))
+
+    def stop(self, timeout=5):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+exporter = Exporter(export_path, export_endpoint)
+
+@app.before_request
+def start_request_span():
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    trace_id, parent_id = parse_traceparent(request.headers.get("traceparent"))
+    g.trace_span = Span("%s %s" %(request.method, rule), "server", trace_id, parent_id,
+        attributes={"http.method": request.method, "http.route": rule, "http.target": request.path})
+    g.trace_token = current_span.set(g.trace_span)
+
+@app.after_request
+def record_response_status(response):
+    if "trace_span" in g:
+        g.trace_span.set(**{"http.status_code": response.status_code})
+        if response.status_code >= 500:
+            g.trace_span.error = "HTTP %d" %response.status_code
+    return response
+
+@app.teardown_request
+def end_request_span(err):
+    if "trace_span" not in g:
+        return
+    root = g.trace_span
+    if err:
+        root.fail(err)
+    try:
+        current_span.reset(g.trace_token)
+    except ValueError:
+        # A streamed response is torn down after its generator finishes, which may be in another context
+        current_span.set(None)
+    root.finish()
+    if root.duration >= slow_request_threshold and root.attributes["http.route"] not in slow_request_exclude:
+        logger.info(format_tree(root))
+    exporter.export(root)
@@ -1,8 +1,11 @@
-from portal import app, auth, logger, connect, jupyterlab, admin
-from flask import session, request, render_template, url_for, redirect, jsonify, flash
-import globus_sdk
+from portal import app, auth, logger, connect, jupyterlab, admin, profile_store, datatables, notebook_events, metrics, lazy
+from flask import session, request, render_template, url_for, redirect, jsonify, flash, make_response, Response, abort
+import hmac
 from urllib.parse import urlparse, urljoin
 from portal.jupyterlab import JupyterLabException
+from portal.jobs import JobQueueFull
+
+globus_sdk = lazy.load("globus_sdk")
 
 @app.route("/")
 def home():
@@ -20,10 +23,11 @@ def hardware():
 def get_gpus():
     try:
         gpus = jupyterlab.get_gpus()
-        return jsonify(gpus=gpus)
+        nodes = jupyterlab.get_gpu_nodes()
+        return jsonify(gpus=gpus, nodes=nodes)
     except Exception as err:
         logger.error(str(err))
-        return jsonify(gpus=[], error="There was an error getting GPU product information.")
+        return jsonify(gpus=[], nodes=[], error="There was an error getting GPU product information.")
 
 @app.route("/signup")
 def signup():
@@ -160,7 +164,7 @@ def aup():
 @app.route("/jupyterlab")
 @auth.members_only
 def open_jupyterlab():
-    return render_template("jupyterlab.html")
+    return render_template("jupyterlab.html", events=notebook_events.enabled)
 
 @app.route("/jupyterlab/get_notebooks")
 @auth.members_only
@@ -173,6 +177,12 @@ def get_notebooks():
         logger.error(str(err))
         return jsonify(notebooks=[], error="There was an error getting user notebooks.")
 
+@app.route("/jupyterlab/events")
+@auth.members_only
+def get_notebook_events():
+    # Event streams are served by portal.asgi; a 204 tells the browser not to reconnect, and the page polls instead
+    return Response(status=204)
+
 @app.route("/jupyterlab/configure")
 @auth.members_only
 def configure_notebook():
@@ -201,11 +211,30 @@ def deploy_notebook():
             "gpu_memory": int(request.form['gpu-memory']),
             "image": request.form['image'],
             "duration": int(request.form['duration'])}
-        jupyterlab.create_notebook(notebook_name, **settings)
+        jupyterlab.validate(notebook_name, **settings)
+        job = jupyterlab.deploys.submit(session["unix_name"], jupyterlab.create_notebook, notebook_name, expected_errors=JupyterLabException, **settings)
     except JupyterLabException as err:
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify(error=str(err)), 400
         flash(str(err), "warning")
         return redirect(url_for("configure_notebook"))
-    return redirect(url_for("open_jupyterlab"))
+    except JobQueueFull as err:
+        logger.warning(str(err))
+        flash("Too many notebooks are being deployed right now. Please try again in a minute.", "warning")
+        return redirect(url_for("configure_notebook"))
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(job_id=job.id)
+    return redirect(url_for("open_jupyterlab", job=job.id))
+
+@app.route("/jupyterlab/deploy/<job_id>")
+@auth.members_only
+def get_deploy_status(job_id):
+    job = jupyterlab.deploys.get(job_id)
+    if not job or job.owner != session["unix_name"]:
+        return jsonify(job_id=job_id, state="unknown")
+    version = request.args.get("version", -1, type=int)
+    job.wait(version, timeout=app.config.get("DEPLOY_STATUS_WAIT", 10))
+    return jsonify(job.to_dict())
 
 @app.route("/jupyterlab/remove/<notebook>")
 @auth.members_only
@@ -265,8 +294,7 @@ def user_info():
 def get_user_profiles():
     try:
         usernames = connect.get_group_members("root.atlas-af")
-        users = connect.get_user_profiles(usernames, date_format="%m/%d/%Y")
-        return jsonify(users=users)
+        return get_profiles_response("users", usernames, date_format="%m/%d/%Y")
     except Exception as err:
         logger.error(str(err))
         return jsonify(error="There was an error getting user profiles.")
@@ -287,12 +315,37 @@ def update_user_institution():
 @app.route("/admin/plot_users_over_time")
 @auth.admins_only
 def plot_users_over_time():
+    return render_template("plot_users_over_time.html", group_by=get_group_by())
+
+@app.route("/admin/plot_users_over_time.png")
+@auth.admins_only
+def plot_users_over_time_png():
     try:
-        data = admin.plot_users_over_time()
-        return render_template("plot_users_over_time.html", base64_encoded_image = data)
+        chart = admin.get_users_over_time_chart(get_group_by())
+        response = make_response(chart["png"])
+        response.mimetype = "image/png"
+        response.set_etag(chart["etag"])
+        response.last_modified = chart["last_modified"]
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     except Exception as err:
         logger.error(str(err))
-        return render_template("500.html")
+        return "", 500
+
+@app.route("/admin/get_users_over_time")
+@auth.admins_only
+def get_users_over_time():
+    try:
+        data = admin.get_users_over_time(get_group_by())
+        return jsonify(data)
+    except Exception as err:
+        logger.error(str(err))
+        return jsonify(error="There was an error getting users over time.")
+
+def get_group_by():
+    group_by = request.args.get("group_by")
+    return group_by if group_by in ("institution", "role") else None
 
 @app.route("/admin/kibana")
 @auth.admins_only
@@ -319,8 +372,7 @@ def groups(group_name):
 def get_group_members(group_name):
     try:
         usernames = connect.get_group_members(group_name, states=["active", "admin"])
-        profiles = connect.get_user_profiles(usernames)
-        return jsonify(members=profiles)
+        return get_profiles_response("members", usernames)
     except Exception as err:
         logger.error(str(err))
         return jsonify(error="There was an error getting member profiles.")
@@ -330,8 +382,7 @@ def get_group_members(group_name):
 def get_group_member_requests(group_name):
     try:
         usernames = connect.get_group_members(group_name, states=["pending"])
-        profiles = connect.get_user_profiles(usernames)
-        return jsonify(member_requests=profiles)
+        return get_profiles_response("member_requests", usernames)
     except Exception as err:
         logger.error(str(err))
         return jsonify(error="There was an error getting member requests.")
@@ -363,12 +414,20 @@ def get_group_potential_members(group_name):
         members = connect.get_group_members(group_name, states=["admin", "active"])
         users = connect.get_group_members("root")
         potential_members = filter(lambda user : user not in members, users)
-        profiles = connect.get_user_profiles(potential_members)
-        return jsonify(potential_members=profiles)
+        return get_profiles_response("potential_members", potential_members)
     except Exception as err:
         logger.error(str(err))
         return jsonify(error="There was an error getting potential members.")
 
+def get_profiles_response(key, usernames, date_format="%B %m %Y"):
+    last_synced = profile_store.get_last_synced()
+    if datatables.is_server_side(request.args):
+        params = datatables.get_params(request.args, profile_store.columns)
+        total, filtered, profiles = profile_store.query_profiles(usernames, date_format=date_format, **params)
+        return jsonify(datatables.get_response(request.args, key, total, filtered, profiles, last_synced=last_synced))
+    profiles = profile_store.get_profiles(usernames, date_format=date_format)
+    return jsonify({key: profiles, "last_synced": last_synced})
+
 @app.route("/admin/email/<group_name>", methods=["POST"])
 @auth.admins_only
 def send_email(group_name):
@@ -525,6 +584,16 @@ def delete_group(group_name):
 def login_nodes():
     return render_template("login_nodes.html")
 
+# Metrics are served only to a scraper that sends the METRICS_TOKEN, and not at all when none is configured
+@app.route("/metrics")
+def get_metrics():
+    token = app.config.get("METRICS_TOKEN")
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), ("Bearer " + token).encode()):
+        return Response("Unauthorized", status=401, headers={"WWW-Authenticate": "Bearer"})
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.errorhandler(404)
 def not_found(e):
     return render_template("404.html")